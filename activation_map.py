@@ -21,30 +21,24 @@ class ActivationMap():
 
     def save_map(self, path):
         with open(path, "w") as f:
-            line = ""
-            for i in range(self.map.shape[1]):
-                for j in range(self.map.shape[0]):
-                    line += str(self.map[j][i]) + ","
-            line = line[:-1]
-            line += "\n"
-            f.write(line)
+            f.write(",".join(str(x) for x in self.map.flatten(order="F")) + "\n")
     
     def load_map(self, path):
-        with open(path, "r") as f:
-            lines = f.readline().strip().split(",")
-            for i in range(self.map.shape[1]):
-                for j in range(self.map.shape[0]):
-                    self.map[j][i] = float(lines[i * self.map.shape[0] + j])
-                    
+        values = np.loadtxt(path, delimiter=",", ndmin=1, max_rows=1)
+        self.map[:] = values.reshape(self.map.shape, order="F")
+
+    def colors(self):
+        shade = np.clip(-np.abs(self.map) * 255 + 255, 0, 255)
+        r = np.where(self.map < 0, 255, shade)
+        g = np.where(self.map > 0, 255, shade)
+        return np.stack([r, g, shade], axis=-1)
+
+    def cell_positions(self):
+        i, j = np.indices(self.map.shape)
+        return np.stack([self.pos[0] + j * (self.size + 5), self.pos[1] + i * self.size], axis=-1)
 
     def draw(self, display):
-        for i in range(self.map.shape[0]):
-            for j in range(self.map.shape[1]):
-                r_amount = np.clip(255 if self.map[i][j] < 0 else -abs(self.map[i][j]) * 255 + 255, 0, 255)
-                g_amount = np.clip(255 if self.map[i][j] > 0 else -abs(self.map[i][j]) * 255 + 255, 0, 255)
-                b_amount = np.clip(-abs(self.map[i][j]) * 255 + 255, 0 , 255)
-                display.draw_circle((self.pos[0] + j*(self.size + 5), self.pos[1] + i*self.size), self.size/2, (r_amount, g_amount, b_amount), thickness=0)
-                display.draw_circle((self.pos[0] + j*(self.size + 5), self.pos[1] + i*self.size), self.size/2, (0, 0, 0), thickness=1)
+        display.draw_activation_map(self)
 
     def mouse(self, pos, amount):
         x, y = pos
@@ -0,0 +1,155 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import numpy as np
+
+import simulation
+
+HEIGHTS = [15, 50, 200]
+DT = 1 / 60
+BRAIN = os.path.join("learning", "model.pack")
+
+
+def measure(fn, min_time=0.2, min_runs=20):
+    for _ in range(3):
+        fn()
+
+    runs = 0
+    start = time.perf_counter_ns()
+    while True:
+        fn()
+        runs += 1
+        elapsed = time.perf_counter_ns() - start
+        if runs >= min_runs and elapsed >= min_time * 1e9:
+            break
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    ns = elapsed / runs
+    return {"ns_per_op": ns, "ops_per_sec": 1e9 / ns, "runs": runs, "peak_bytes": peak}
+
+
+def settled_simulation(height):
+    sim = simulation.Simulation()
+    sim.createHydra(height)
+    sim.run(1, DT, record=False)
+    return sim
+
+
+def bench_height(height, min_time):
+    results = {}
+    sim = settled_simulation(height)
+    hydra = sim.hydra
+
+    results["Simulation.step"] = measure(lambda: sim.step(60), min_time)
+    results["Hydra.calc_area"] = measure(hydra.calc_area, min_time)
+    # the same calls Hydra.step makes, on a fixed gather so nothing reaches the space
+    pos = hydra.state.gather()
+    forces = np.zeros((hydra.state.n_cells, 2))
+    results["HydraState.wall_forces"] = measure(lambda: hydra.state.wall_forces(pos, 1000, DT, out=forces), min_time)
+    # a settled bank is idle, so keep every muscle excited or the step returns straight away
+    bank = hydra.muscle_bank
+    bank.drive(slice(None), 0.2, float("inf"))
+    results["MuscleBank.step"] = measure(lambda: bank.step(pos, DT, forces), min_time)
+    bank.drive(slice(None), 0, 0)
+
+    def rollout():
+        fresh = simulation.Simulation()
+        fresh.createHydra(height)
+        fresh.hydra.play_excitation(np.full((height - 1, 3), 0.2))
+        fresh.run(5, DT, record=False)
+    results["rollout_5s"] = measure(rollout, min_time, min_runs=1)
+    results["rollout_5s"]["sim_seconds_per_sec"] = 5 * results["rollout_5s"]["ops_per_sec"]
+
+    if height == simulation.hydra.HYDRA_HEIGHT:
+        hydra.load_brain(BRAIN)
+        nerve = np.random.default_rng(0).uniform(-1, 1, (height - 1, 2))
+        hydra.brain.cache_size = 0
+        results["Hydra.play_input"] = measure(lambda: hydra.play_input(nerve), min_time)
+        results["ActivationMap.draw"] = bench_draw(sim, min_time)
+
+    return results
+
+
+def bench_draw(sim, min_time):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+    try:
+        import pygame
+        from viewer import Display, SCREEN_SIZE
+    except ImportError:
+        return None
+    pygame.init()
+    screen = pygame.display.set_mode((SCREEN_SIZE, SCREEN_SIZE))
+    display = Display(SCREEN_SIZE, (0, 0), screen)
+    amap = sim.muscle_activation
+    amap.map = np.random.default_rng(0).uniform(-1, 1, amap.map.shape)
+    return measure(lambda: amap.draw(display), min_time)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=ROOT).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline):
+    print(f"\nCompared with {baseline.get('commit')}:")
+    for height, benches in results["heights"].items():
+        for name, result in benches.items():
+            old = baseline["heights"].get(height, {}).get(name)
+            if result is None or old is None:
+                continue
+            ratio = old["ns_per_op"] / result["ns_per_op"]
+            flag = "  REGRESSION" if ratio < 0.9 else ""
+            print(f"  h={height:>4} {name:22s} {ratio:6.2f}x{flag}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark simulation hot paths")
+    parser.add_argument("--heights", type=int, nargs="+", default=HEIGHTS)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to spend on each benchmark")
+    parser.add_argument("--json", default=None, help="write results to this file")
+    parser.add_argument("--compare", default=None, help="previous JSON results to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "heights": {},
+    }
+    for height in args.heights:
+        print(f"HYDRA height {height}")
+        benches = bench_height(height, args.min_time)
+        results["heights"][str(height)] = benches
+        for name, result in benches.items():
+            if result is None:
+                print(f"  {name:22s} skipped")
+                continue
+            print(f"  {name:22s} {result['ns_per_op']:14.0f} ns/op {result['ops_per_sec']:12.1f} ops/s "
+                  f"{result['peak_bytes'] / 1024:10.1f} KiB peak")
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
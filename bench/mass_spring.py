@@ -0,0 +1,102 @@
+import glob
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import numpy as np
+
+import simulation
+from activation_map import ActivationMap
+from hydra import HydraConfig
+from mass_spring import MassSpringHydras
+
+DT = 1 / 60
+BATCHES = [1, 16, 64, 256]
+
+
+def load_maps(pattern, config):
+    maps = []
+    for path in sorted(glob.glob(pattern)):
+        amap = ActivationMap(config.muscle_shape, (0, 0), 0)
+        amap.load_map(path)
+        maps.append(amap.map.copy())
+    return np.array(maps)
+
+
+def reference(maps, duration, config):
+    trajectories = []
+    start = time.perf_counter()
+    for map in maps:
+        sim = simulation.Simulation(config)
+        sim.createHydra()
+        sim.hydra.play_excitation(map)
+        trajectories.append(sim.run(duration, DT)["positions"])
+    return np.stack(trajectories, axis=1), time.perf_counter() - start
+
+
+def agreement(maps, duration, config):
+    ref, _ = reference(maps, duration, config)
+    batch = MassSpringHydras(len(maps), config)
+    batch.play_excitation(maps)
+    out = batch.run(duration, DT)
+
+    error = np.linalg.norm(out - ref, axis=-1)
+    motion = np.linalg.norm(ref - ref[:1], axis=-1).max(axis=(0, 2))
+    return {
+        "max_error": float(error.max()),
+        "final_rms_error": float(np.sqrt((error[-1] ** 2).mean())),
+        "max_error_per_map": error.max(axis=(0, 2)).tolist(),
+        "max_motion_per_map": motion.tolist(),
+    }
+
+
+def throughput(batches, duration, config, seed=0):
+    rng = np.random.default_rng(seed)
+    results = {}
+
+    maps = rng.uniform(-0.5, 0.5, (max(1, min(batches) * 4),) + config.muscle_shape)
+    _, wall = reference(maps, duration, config)
+    results["pymunk"] = len(maps) * duration / wall
+
+    for size in batches:
+        batch = MassSpringHydras(size, config)
+        batch.play_excitation(rng.uniform(-0.5, 0.5, (size,) + config.muscle_shape))
+        start = time.perf_counter()
+        batch.run(duration, DT, record=False)
+        results[f"batch_{size}"] = size * duration / (time.perf_counter() - start)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare the batched mass-spring backend against pymunk")
+    parser.add_argument("--maps", default="learning/data/*.out", help="muscle maps to check agreement on")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--batches", type=int, nargs="+", default=BATCHES)
+    parser.add_argument("--height", type=int, default=simulation.hydra.HYDRA_HEIGHT)
+    parser.add_argument("--json", default=None, help="write results to this file")
+    args = parser.parse_args()
+
+    config = HydraConfig(args.height)
+    results = {}
+    maps = load_maps(args.maps, config) if args.height == simulation.hydra.HYDRA_HEIGHT else np.zeros((0,))
+    if len(maps):
+        results["agreement"] = agreement(maps, args.duration, config)
+        a = results["agreement"]
+        print(f"Agreement over {len(maps)} maps, {args.duration:g}s: max error {a['max_error']:.4f}, "
+              f"final RMS error {a['final_rms_error']:.4f} (largest motion {max(a['max_motion_per_map']):.1f})")
+
+    results["sim_seconds_per_sec"] = rates = throughput(args.batches, args.duration, config)
+    print(f"Throughput in simulated hydra-seconds per wall second:")
+    for name, rate in rates.items():
+        print(f"  {name:10s} {rate:10.1f} ({rate / rates['pymunk']:6.1f}x pymunk)")
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,63 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = ["cell", "muscle", "hydra", "simulation", "rollout", "neuron", "recorder",
+                "learning.inference", "viewer"]
+HEAVY_MODULES = ["torch", "pygame", "pandas", "dill"]
+
+PROBE = """
+import json, resource, sys, time
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{
+    "import_ms": elapsed * 1000,
+    "rss_mb": after / 1024,
+    "rss_delta_mb": (after - before) / 1024,
+    "heavy": [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+
+def measure(module, repeats=3):
+    runs = []
+    for _ in range(repeats):
+        env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1")
+        out = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                             cwd=ROOT, env=env, capture_output=True, text=True)
+        if out.returncode != 0:
+            return {"error": out.stderr.strip().splitlines()[-1]}
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    best = min(runs, key=lambda r: r["import_ms"])
+    return best
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure import time and memory of each entry point")
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--json", default=None, help="write results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for module in args.modules:
+        result = measure(module, args.repeats)
+        results[module] = result
+        if "error" in result:
+            print(f"{module:20s} failed: {result['error']}")
+        else:
+            heavy = ", ".join(result["heavy"]) or "-"
+            print(f"{module:20s} {result['import_ms']:8.1f} ms {result['rss_mb']:8.1f} MB peak "
+                  f"(+{result['rss_delta_mb']:.1f} MB)  heavy: {heavy}")
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -2,6 +2,8 @@ import pymunk
 
 CELL_RADIUS = 3
 CELL_COLOR = (0, 0, 0)
+# cells sharing a group never collide, so neither neighbouring cells nor separate hydras touch
+CELL_GROUP = 1
 
 class Cell:
     def __init__(self, x, y, space): 
@@ -10,7 +12,7 @@ class Cell:
         self.shape = pymunk.Circle(self.body, CELL_RADIUS)
         self.shape.elasticity = 0
         self.shape.density = 1
-        self.shape.filer = pymunk.ShapeFilter(group=1)
+        self.shape.filter = pymunk.ShapeFilter(group=CELL_GROUP)
         self.muscles = []
         space.add(self.body, self.shape)
 
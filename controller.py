@@ -0,0 +1,122 @@
+import threading
+
+import numpy as np
+
+CONTROL_RATE = 10
+
+
+def sense(hydra):
+    config = hydra.config
+    pos = hydra.state.gather()
+    centers = (pos[hydra.state.left] + pos[hydra.state.right]) / 2
+    lateral = (centers[1:, 0] - centers[0, 0]) / config.cell_width
+
+    # spread the wall length over the segments in proportion to their center spacing
+    segments = np.linalg.norm(np.diff(centers, axis=0), axis=1)
+    length = hydra.calc_length() * segments / segments.sum()
+    strain = length / config.cell_height - 1 + hydra.pressure / config.bulk_modulus
+
+    return np.clip(np.stack([lateral, strain], axis=1), -1, 1)
+
+
+class InferenceWorker:
+
+    def __init__(self, brain):
+        self.brain = brain
+        self.pending = None
+        self.latest = None
+        self.in_flight = None
+        self.generation = 0
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                sensed, self.pending = self.pending, None
+                self.in_flight = sensed
+                generation = self.generation
+            result = self.brain(sensed)
+            with self.condition:
+                # a restore since the input was taken makes the result stale
+                if generation == self.generation:
+                    self.latest = result
+                    self.in_flight = None
+
+    def exchange(self, sensed):
+        with self.condition:
+            self.pending = sensed
+            self.condition.notify()
+            return self.latest
+
+    def snapshot(self):
+        with self.condition:
+            return self.pending, self.latest, self.in_flight
+
+    def restore(self, state):
+        pending, latest, in_flight = state
+        with self.condition:
+            # an input that was being evaluated is queued again, since its result is discarded
+            self.pending = pending if pending is not None else in_flight
+            self.latest = latest
+            self.in_flight = None
+            self.generation += 1
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+
+class BrainController:
+
+    def __init__(self, hydra, brain=None, rate=CONTROL_RATE, encoder=sense, threaded=True):
+        self.hydra = hydra
+        self.brain = brain if brain is not None else hydra.brain
+        self.period = 1 / rate
+        self.encoder = encoder
+        self.next_tick = None
+        self.command = None
+        self.ticks = 0
+        self.worker = InferenceWorker(self.brain) if threaded else None
+
+    def step(self, time):
+        if self.next_tick is None:
+            self.next_tick = time
+        if time < self.next_tick:
+            return
+        while self.next_tick <= time:
+            self.next_tick += self.period
+
+        sensed = self.encoder(self.hydra)
+        if self.worker is not None:
+            command = self.worker.exchange(sensed)
+        else:
+            command = self.brain(sensed)
+
+        self.ticks += 1
+        if command is not None:
+            self.command = command
+            self.hydra.drive_excitation(command, self.period)
+
+    def snapshot(self):
+        worker = self.worker.snapshot() if self.worker is not None else None
+        return self.next_tick, self.command, self.ticks, worker
+
+    def restore(self, state):
+        self.next_tick, self.command, self.ticks, worker = state
+        if self.worker is not None:
+            self.worker.restore(worker)
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.close()
+            self.worker = None
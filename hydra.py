@@ -1,62 +1,140 @@
-from math import sqrt, pow, log
-from cell import Cell, CellFixed
-from muscle import EndodermMuscle, EctodermMuscle
+from cell import Cell, CellFixed, CELL_RADIUS, CELL_COLOR
+from muscle import EndodermMuscle, EctodermMuscle, MuscleBank
+from muscle import CELL_HEIGHT, CELL_WIDTH, CONTRACTION_GAIN, EXCITATION_DECAY_RATE
+from muscle import ENDODERM_STIFFNESS, ENDODERM_DAMPING, ENDODERM_MAX_FORCE
+from muscle import ECTODERM_STIFFNESS, ECTODERM_DAMPING, ECTODERM_MAX_FORCE
+from hydra_state import HydraState, PRESSURE_THRESHOLD, BODY_FIELDS
 import pymunk
 import numpy as np
 
-import torch
-import torch.nn as nn
-from learning.motor_control import MotorControl
-
-WATER_BULK_MODULUS = 2.15 * pow(10, 5)
+WATER_BULK_MODULUS = 2.15 * 10 ** 5
 
 HYDRA_HEIGHT = 15
-CELL_HEIGHT = 20
-CELL_WIDTH = 60
+
+EXCITATION_DURATION = 15
+EXPLODING_SPEED = 500
+EXPLODING_DISTANCE = 500
+
+STATUSES = ("STABLE", "STUCK", "EXPLODING", "MOVING")
+
+class HydraConfig:
+
+    def __init__(self, height=HYDRA_HEIGHT, cell_height=CELL_HEIGHT, cell_width=CELL_WIDTH,
+                 endoderm_stiffness=ENDODERM_STIFFNESS, endoderm_damping=ENDODERM_DAMPING,
+                 endoderm_max_force=ENDODERM_MAX_FORCE, ectoderm_stiffness=ECTODERM_STIFFNESS,
+                 ectoderm_damping=ECTODERM_DAMPING, ectoderm_max_force=ECTODERM_MAX_FORCE,
+                 contraction_gain=CONTRACTION_GAIN, decay_rate=EXCITATION_DECAY_RATE,
+                 bulk_modulus=WATER_BULK_MODULUS, excitation_duration=EXCITATION_DURATION):
+        self.height = height
+        self.cell_height = cell_height
+        self.cell_width = cell_width
+        self.endoderm_stiffness = endoderm_stiffness
+        self.endoderm_damping = endoderm_damping
+        self.endoderm_max_force = endoderm_max_force
+        self.ectoderm_stiffness = ectoderm_stiffness
+        self.ectoderm_damping = ectoderm_damping
+        self.ectoderm_max_force = ectoderm_max_force
+        self.contraction_gain = contraction_gain
+        self.decay_rate = decay_rate
+        self.bulk_modulus = bulk_modulus
+        self.excitation_duration = excitation_duration
+
+    def replace(self, **changes):
+        config = HydraConfig(**vars(self))
+        for name, value in changes.items():
+            if not hasattr(config, name):
+                raise TypeError(f"HydraConfig has no parameter {name!r}")
+            setattr(config, name, value)
+        return config
+
+    @property
+    def segments(self):
+        return self.height - 1
+
+    @property
+    def nerve_shape(self):
+        return (self.segments, 2)
+
+    @property
+    def muscle_shape(self):
+        return (self.segments, 3)
+
+    @property
+    def brain_input_size(self):
+        return self.segments * 2
+
+    @property
+    def brain_output_size(self):
+        return self.segments * 3
+
 
 class Hydra:
 
-    def __init__(self, space):
-        self.height = HYDRA_HEIGHT
+    def __init__(self, space, height=HYDRA_HEIGHT, config=None, offset=(0, 0)):
+        # an explicit config wins over height
+        self.config = config = HydraConfig(height) if config is None else config
+        self.height = config.height
+        self.offset = offset
 
         self.cells = []
         self.layers = []
         self.endoderm_muscles = []
         self.ectoderm_muscles = []
         self.roof = None
+        self.pin = None
 
-        self.brain = None
+        self._brain = None
+        self.brain_path = None
 
         self.area = -1
+        self.pressure = 0
+        self.state = None
+        self.muscle_bank = None
+        self.profiler = None
         self.original_head_pos = None
         self.status = "STABLE"
 
-        left =   - (CELL_WIDTH / 2)
-        right = (CELL_WIDTH / 2)
+        x, y = offset
+        left = x - (config.cell_width / 2)
+        right = x + (config.cell_width / 2)
+        endoderm = dict(stiffness=config.endoderm_stiffness, damping=config.endoderm_damping,
+                        length=config.cell_width, max_force=config.endoderm_max_force)
+        ectoderm = dict(stiffness=config.ectoderm_stiffness, damping=config.ectoderm_damping,
+                        length=config.cell_height, max_force=config.ectoderm_max_force)
 
-        fc1 = CellFixed(left, 2, space)
-        fc2 = CellFixed(right, 2, space)
+        fc1 = CellFixed(left, y + 2, space)
+        fc2 = CellFixed(right, y + 2, space)
         self.cells.extend([fc1, fc2])
         self.layers.append((fc1, fc2))
 
         for i in range(1, self.height):
-            c1 = Cell(left, i * CELL_HEIGHT + 2, space)
-            c2 = Cell(right, i * CELL_HEIGHT + 2, space)
-            self.endoderm_muscles.append(EndodermMuscle(c1, c2, space))
+            c1 = Cell(left, y + i * config.cell_height + 2, space)
+            c2 = Cell(right, y + i * config.cell_height + 2, space)
+            self.endoderm_muscles.append(EndodermMuscle(c1, c2, space, **endoderm))
 
             b1, b2 = self.layers[i - 1]
-            self.ectoderm_muscles.append(EctodermMuscle(b1, c1, "LEFT", space))
-            self.ectoderm_muscles.append(EctodermMuscle(b2, c2, "RIGHT", space))
+            self.ectoderm_muscles.append(EctodermMuscle(b1, c1, "LEFT", space, **ectoderm))
+            self.ectoderm_muscles.append(EctodermMuscle(b2, c2, "RIGHT", space, **ectoderm))
 
             self.layers.append((c1, c2))
             self.cells.extend((c1, c2))
         
         self.roof = self.endoderm_muscles[-1]
-        pin = pymunk.PinJoint(self.roof.body1, self.roof.body2, (0, 0), (0, 0))
-        space.add(pin)
+        self.pin = pymunk.PinJoint(self.roof.body1, self.roof.body2, (0, 0), (0, 0))
+        space.add(self.pin)
+
+        muscles = self.endoderm_muscles + self.ectoderm_muscles
+        self.state = HydraState(self.cells, self.layers, muscles, self.roof)
+        self.muscle_bank = MuscleBank(muscles, self.state.muscle_a, self.state.muscle_b,
+                                      config.contraction_gain, config.decay_rate)
+
+        endoderm = np.arange(len(self.endoderm_muscles))
+        ectoderm = len(self.endoderm_muscles) + np.arange(len(self.ectoderm_muscles))
+        self.endoderm_index = endoderm
+        self.ectoderm_index = ectoderm
+        self.excitation_index = np.stack([ectoderm[0::2], endoderm, ectoderm[1::2]], axis=1)
 
         self.original_head_pos = (self.roof.body1.position + self.roof.body2.position) / 2
-        print(self.original_head_pos)
         self.area = self.calc_area()
     
     def get_status(self):
@@ -68,24 +146,53 @@ class Hydra:
             self.status = "STABLE"
         elif spd <2:
             self.status = "STUCK"
-        elif spd > 500 or dist > 500:
+        elif spd > EXPLODING_SPEED or dist > EXPLODING_DISTANCE:
             self.status = "EXPLODING"
         else:
             self.status = "MOVING"
 
     def calc_area(self):
-        area = 0
-        for i in range(1, len(self.layers)):
-            l11, l12 = self.layers[i - 1]
-            l21, l22 = self.layers[i]
-
-            l11 = l11.body.position
-            l12 = l12.body.position
-            l21 = l21.body.position
-            l22 = l22.body.position
-
-            area += calc_area_quad(l11, l12, l21, l22)
-        return area
+        return self.state.calc_area(self.state.gather())
+
+    def snapshot(self):
+        # area, pressure, status, then one row per dynamic body and the muscle bank arrays
+        bank = self.muscle_bank
+        return np.concatenate([
+            [self.area, self.pressure, STATUSES.index(self.status)],
+            self.state.save_bodies().ravel(),
+            bank.excitation, bank.excitation_duration, bank.activation,
+        ])
+
+    def snapshot_size(self):
+        return 3 + len(self.state.dynamic) * BODY_FIELDS + 3 * self.muscle_bank.n_muscles
+
+    def restore(self, blob):
+        if len(blob) != self.snapshot_size():
+            raise ValueError(f"snapshot has {len(blob)} values, expected {self.snapshot_size()}")
+        bank = self.muscle_bank
+        n_bodies = len(self.state.dynamic) * BODY_FIELDS
+        n_muscles = bank.n_muscles
+
+        self.area = float(blob[0])
+        self.pressure = float(blob[1])
+        self.status = STATUSES[int(blob[2])]
+        self.state.load_bodies(self.snapshot_bodies(blob))
+        muscles = blob[3 + n_bodies:]
+        bank.excitation[:] = muscles[:n_muscles]
+        bank.excitation_duration[:] = muscles[n_muscles:2 * n_muscles]
+        bank.activation[:] = muscles[2 * n_muscles:]
+        bank.refresh()
+
+    def snapshot_bodies(self, blob):
+        # the body rows inside one of this hydra's snapshots, as save_bodies returns them
+        return blob[3:3 + len(self.state.dynamic) * BODY_FIELDS].reshape(-1, BODY_FIELDS)
+
+    def remove(self, space):
+        for cell in self.cells:
+            space.remove(cell.body, cell.shape)
+        for muscle in self.endoderm_muscles + self.ectoderm_muscles:
+            space.remove(muscle.joint)
+        space.remove(self.pin)
 
     def calc_peri(self):
         peri = 0
@@ -99,15 +206,45 @@ class Hydra:
 
         return (diff1.length + diff2.length) / 2
 
+    def asleep(self):
+        # pymunk sleeps a hydra's bodies together, so the roof stands in for all of them
+        return self.roof.body1.is_sleeping and self.muscle_bank.idle
+
+    def wake(self):
+        self.roof.body1.activate()
+
     def step(self, step_size):
+        if self.asleep():
+            return
+        prof = self.profiler
+        t = prof.start() if prof else 0
         self.get_status()
-        pressure = self.calc_pressure(self.calc_area())
-
-        if pressure > 100:
-            self.push_walls(pressure, step_size)
+        if self.status != "STABLE":
+            # resetting one body's idle time keeps the whole hydra from falling asleep
+            self.wake()
+        pos = self.state.gather()
+        forces = self.state.forces
+        forces.fill(0)
+        if prof:
+            t = prof.lap("gather", t)
+
+        self.muscle_bank.step(pos, step_size, forces)
+        if prof:
+            t = prof.lap("muscles", t)
+
+        self.pressure = self.calc_pressure(self.state.calc_area(pos))
+        if self.pressure > PRESSURE_THRESHOLD:
+            self.state.wall_forces(pos, self.pressure, step_size, out=forces)
+        if prof:
+            t = prof.lap("pressure", t)
+
+        if forces.any():
+            self.state.apply_forces(forces)
+        if prof:
+            prof.lap("apply forces", t)
 
     def calc_pressure(self, area):
-        return - WATER_BULK_MODULUS * log(area / self.area)
+        return - self.config.bulk_modulus * np.log(area / self.area)
 
     def calc_center(self, layer):
         p1 = self.layers[layer][0].body.position
@@ -115,81 +252,64 @@ class Hydra:
         return (p1 + p2) / 2
 
     def push_walls(self, pressure, step_size):
-        for layer in self.layers:
-            cell1 = layer[0]
-            cell2 = layer[1]
-
-            norm =(cell1.body.position - cell2.body.position).normalized()
-            length1 = sum([x.muscle_length() for x in cell1.muscles])
-            length2 = sum([x.muscle_length() for x in cell2.muscles])
-            cell1.apply_force(norm * length1 * pressure * step_size)
-            cell2.apply_force(-norm * length2 *pressure * step_size)
-
-        force = -self.roof.muscle_length() * pressure * self.roof.muscle_vec().perpendicular()
-        self.roof.push_muscle(force * step_size)
+        forces = self.state.wall_forces(self.state.gather(), pressure, step_size)
+        self.state.apply_forces(forces)
 
 
     def draw(self, display):
-        for muscle in self.endoderm_muscles:
-            muscle.draw(display)
-        for muscle in self.ectoderm_muscles:
-            muscle.draw(display)
-        for cell in self.cells:
-            cell.draw(display)
+        pos = self.state.gather()
+        left = pos[self.state.left]
+        right = pos[self.state.right]
+
+        endoderm = self.endoderm_muscles[0]
+        ectoderm = self.ectoderm_muscles[0]
+        display.draw_segments(left[1:], right[1:], endoderm.color, endoderm.line_width())
+        display.draw_lines(left, ectoderm.color, ectoderm.line_width())
+        display.draw_lines(right, ectoderm.color, ectoderm.line_width())
+        display.draw_circles(pos, CELL_RADIUS, CELL_COLOR)
 
         #display.draw_log(f"Length: {self.calc_length():.2f}", (0, 0, 0))
         #display.draw_log(f"Pressure: {self.calc_pressure(self.calc_area()):.2f}", (0, 0, 0))
         #display.draw_log(f"Status: {self.status}", (0, 0, 0))
         
     def contract(self):
-        for muscle in self.ectoderm_muscles:
-            muscle.excite(0.5, 5)
+        self.muscle_bank.excite(self.ectoderm_index, 0.5, 5)
     
     def elongate(self):
-        for muscle in self.endoderm_muscles:
-            muscle.excite(0.5, 10)
+        self.muscle_bank.excite(self.endoderm_index, 0.5, 10)
+
+    def play_excitation(self, map, duration=None):
+        if duration is None:
+            duration = self.config.excitation_duration
+        self.muscle_bank.excite(self.excitation_index, map, duration)
 
-    def play_excitation(self, map):
-        for i in range(HYDRA_HEIGHT - 1):
-            self.ectoderm_muscles[i * 2].excite(map[i][0], 15)
-            self.ectoderm_muscles[i * 2 + 1].excite(map[i][2], 15)
-            self.endoderm_muscles[i].excite(map[i][1], 15)
+    def drive_excitation(self, map, duration):
+        # hold the rate play_excitation would use, renewed every control tick
+        self.muscle_bank.drive(self.excitation_index, np.asarray(map) / self.config.excitation_duration, duration)
 
     def get_excitation(self):
-        map = np.zeros((HYDRA_HEIGHT - 1, 3))
-        for i in range(HYDRA_HEIGHT - 1):
-            map[i][0] = self.ectoderm_muscles[i * 2].activation
-            map[i][2] = self.ectoderm_muscles[i * 2 + 1].activation
-            map[i][1] = self.endoderm_muscles[i].activation
-        return map
+        return self.muscle_bank.activation[self.excitation_index]
     
     def play_input(self, activation_map):
         if self.brain == None:
             print("")
             return
-        self.brain.eval()
-        flatten = activation_map.flatten(order="F")
-        response = self.brain(torch.tensor(flatten, dtype=torch.float32))
-
-        map = response.detach().numpy()
-        map = map.reshape((HYDRA_HEIGHT - 1, 3), order='F')
+        map = self.brain(activation_map)
         self.play_excitation(map)
         return map
 
-    def load_brain(self, model_state_path):
-        self.brain = MotorControl()
-        self.brain.load_state_dict(torch.load(model_state_path))
-
-
-def calc_area_quad(p11, p12, p21, p22):
-    return calc_area_tri(p11, p12, p21) + calc_area_tri(p12, p21, p22)
+    @property
+    def brain(self):
+        if self._brain is None and self.brain_path is not None:
+            from learning.inference import MotorInference
+            self._brain = MotorInference.load(self.brain_path)
+        return self._brain
 
-def calc_area_tri(p1, p2, p3):
-    s1 = p1 - p2
-    s2 = p2 - p3
-    s3 = p3 - p1
-    s1 = s1.length
-    s2 = s2.length
-    s3 = s3.length
-    return (s2 * sqrt(s1**2 - ((s1**2 + s2**2 - s3**2) / (2*s2))**2)) / 2
+    @brain.setter
+    def brain(self, brain):
+        self._brain = brain
 
+    def load_brain(self, model_state_path):
+        # the model is only read the first time the brain is used
+        self.brain_path = model_state_path
+        self._brain = None
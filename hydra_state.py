@@ -0,0 +1,97 @@
+import numpy as np
+
+PRESSURE_THRESHOLD = 100
+BODY_FIELDS = 9
+
+class HydraState:
+
+    def __init__(self, cells, layers, muscles, roof):
+        self.bodies = [cell.body for cell in cells]
+        index = {id(body): i for i, body in enumerate(self.bodies)}
+
+        self.n_cells = len(self.bodies)
+        self.left = np.array([index[id(l[0].body)] for l in layers], dtype=np.intp)
+        self.right = np.array([index[id(l[1].body)] for l in layers], dtype=np.intp)
+        self.muscle_a = np.array([index[id(m.body1)] for m in muscles], dtype=np.intp)
+        self.muscle_b = np.array([index[id(m.body2)] for m in muscles], dtype=np.intp)
+        self.roof = np.array([index[id(roof.body1)], index[id(roof.body2)]], dtype=np.intp)
+
+        # body wall outline: up the left side, back down the right side
+        self.outline = np.concatenate([self.left, self.right[::-1]])
+        self.dynamic = np.array([i for i, body in enumerate(self.bodies)
+                                 if body.body_type == body.DYNAMIC], dtype=np.intp)
+
+        self.forces = np.zeros((self.n_cells, 2))
+
+    def gather(self):
+        return np.array([body.position for body in self.bodies], dtype=np.float64)
+
+    def gather_velocities(self):
+        return np.array([body.velocity for body in self.bodies], dtype=np.float64)
+
+    def save_bodies(self):
+        return save_bodies([self.bodies[i] for i in self.dynamic])
+
+    def load_bodies(self, rows):
+        load_bodies([self.bodies[i] for i in self.dynamic], rows)
+
+    def calc_area(self, pos):
+        return shoelace_area(pos[..., self.outline, :])
+
+    def muscle_lengths(self, pos):
+        return np.linalg.norm(pos[..., self.muscle_a, :] - pos[..., self.muscle_b, :], axis=-1)
+
+    def wall_lengths(self, pos):
+        lengths = self.muscle_lengths(pos)
+        walls = np.zeros(lengths.shape[:-1] + (self.n_cells,))
+        np.add.at(walls, (..., self.muscle_a), lengths)
+        np.add.at(walls, (..., self.muscle_b), lengths)
+        return walls
+
+    def wall_forces(self, pos, pressure, step_size, out=None):
+        if out is None:
+            out = np.zeros(pos.shape)
+        pressure = np.asarray(pressure, dtype=np.float64)[..., None]
+        walls = self.wall_lengths(pos)
+
+        norm = normalized(pos[..., self.left, :] - pos[..., self.right, :])
+        scale = pressure * step_size
+        out[..., self.left, :] += norm * (walls[..., self.left] * scale)[..., None]
+        out[..., self.right, :] -= norm * (walls[..., self.right] * scale)[..., None]
+
+        roof = pos[..., self.roof[0], :] - pos[..., self.roof[1], :]
+        roof_length = np.linalg.norm(roof, axis=-1, keepdims=True)
+        roof_force = -perpendicular(roof / roof_length) * roof_length * scale
+        out[..., self.roof[0], :] += roof_force
+        out[..., self.roof[1], :] += roof_force
+        return out
+
+    def apply_forces(self, forces):
+        for i, (fx, fy) in zip(self.dynamic.tolist(), forces[self.dynamic].tolist()):
+            self.bodies[i].apply_force_at_local_point((fx, fy), (0, 0))
+
+
+def save_bodies(bodies):
+    # x, y, vx, vy, angle, w, fx, fy, torque per body
+    return np.array([(*body.position, *body.velocity, body.angle, body.angular_velocity, *body.force, body.torque)
+                     for body in bodies], dtype=np.float64).reshape(-1, BODY_FIELDS)
+
+def load_bodies(bodies, rows):
+    for body, (x, y, vx, vy, angle, w, fx, fy, torque) in zip(bodies, rows.tolist()):
+        body.position = x, y
+        body.velocity = vx, vy
+        body.angle = angle
+        body.angular_velocity = w
+        body.force = fx, fy
+        body.torque = torque
+
+def shoelace_area(poly):
+    x = poly[..., 0]
+    y = poly[..., 1]
+    return np.abs(np.sum(x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y, axis=-1)) / 2
+
+def normalized(vec):
+    return vec / np.linalg.norm(vec, axis=-1, keepdims=True)
+
+def perpendicular(vec):
+    return np.stack([-vec[..., 1], vec[..., 0]], axis=-1)
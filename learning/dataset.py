@@ -0,0 +1,67 @@
+from os import path, listdir
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from packfile import write_pack, read_pack
+
+INPUT_NOISE = 0.1
+TARGET_NOISE = 0.01
+
+
+def read_map(file):
+    return np.loadtxt(file, delimiter=",", dtype=np.float32, ndmin=1)
+
+
+def pack_dataset(src, out):
+    labels = sorted(f.replace(".in", "") for f in listdir(src) if f.endswith(".in"))
+    inputs = np.stack([read_map(path.join(src, label + ".in")) for label in labels])
+    targets = np.stack([read_map(path.join(src, label + ".out")) for label in labels])
+    meta = {"format": "motor_dataset", "version": 1, "labels": labels, "source": src}
+    write_pack(out, {"inputs": inputs, "targets": targets}, meta)
+    return labels
+
+
+def noise(example, noise_level):
+    return example + (torch.randn(example.shape) * example * noise_level)
+
+
+class MotorDataset(Dataset):
+    def __init__(self, src, input_noise=INPUT_NOISE, target_noise=TARGET_NOISE):
+        arrays, meta = read_pack(src)
+        self.inputs = torch.from_numpy(np.array(arrays["inputs"]))
+        self.targets = torch.from_numpy(np.array(arrays["targets"]))
+        self.data_labels = meta["labels"]
+        self.input_noise = input_noise
+        self.target_noise = target_noise
+
+    def __len__(self):
+        return len(self.data_labels)
+
+    def __getitem__(self, idx):
+        return self.augment(self.inputs[idx:idx + 1], self.targets[idx:idx + 1])
+
+    def augment(self, inputs, targets):
+        return noise(inputs, self.input_noise), noise(targets, self.target_noise)
+
+    def batches(self, batch_size, shuffle=True, generator=None, indices=None):
+        if indices is None:
+            indices = torch.arange(len(self))
+        if shuffle:
+            indices = indices[torch.randperm(len(indices), generator=generator)]
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            yield self.augment(self.inputs[batch], self.targets[batch])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pack .in/.out motor examples into a single binary file")
+    parser.add_argument("src", nargs="?", default="learning/data")
+    parser.add_argument("out", nargs="?", default="learning/data.pack")
+    args = parser.parse_args()
+
+    labels = pack_dataset(args.src, args.out)
+    print(f"Packed {len(labels)} examples into {args.out}")
@@ -0,0 +1,21 @@
+from torch.nn import Linear, ReLU, Module, ModuleList
+
+hidden_size = 256
+n_hidden = 2
+
+class DynamicsModel(Module):
+    # maps one surrogate step's normalized state features to the normalized change in state
+    def __init__(self, input_size, output_size, hidden_size=hidden_size, n_hidden=n_hidden):
+        super(DynamicsModel, self).__init__()
+        sizes = [input_size] + [hidden_size] * n_hidden + [output_size]
+        self.layers = ModuleList(Linear(a, b) for a, b in zip(sizes[:-1], sizes[1:]))
+        self.relu = ReLU()
+
+    def forward(self, x):
+        for layer in self.layers[:-1]:
+            x = self.relu(layer(x))
+        return self.layers[-1](x)
+
+if __name__ == "__main__":
+    net = DynamicsModel(4 * 28 + 42 + 1, 4 * 28 + 1)
+    print(net)
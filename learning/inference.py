@@ -0,0 +1,158 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from packfile import write_pack, read_pack, is_pack
+
+FORMAT_VERSION = 1
+CACHE_SIZE = 4096
+QUANTUM = 1e-3
+
+
+def flatten_maps(maps):
+    maps = np.asarray(maps, dtype=np.float32)
+    return maps.transpose(0, 2, 1).reshape(len(maps), -1)
+
+def unflatten_maps(flat, columns):
+    return flat.reshape(len(flat), columns, -1).transpose(0, 2, 1)
+
+
+class NumpyMotorControl:
+    def __init__(self, fc1_weight, fc1_bias, fc2_weight, fc2_bias):
+        self.fc1_weight = np.ascontiguousarray(fc1_weight, dtype=np.float32)
+        self.fc1_bias = np.ascontiguousarray(fc1_bias, dtype=np.float32)
+        self.fc2_weight = np.ascontiguousarray(fc2_weight, dtype=np.float32)
+        self.fc2_bias = np.ascontiguousarray(fc2_bias, dtype=np.float32)
+        self.input_size = self.fc1_weight.shape[1]
+        self.output_size = self.fc2_weight.shape[0]
+
+    def __call__(self, x):
+        x = np.maximum(x @ self.fc1_weight.T + self.fc1_bias, 0)
+        return np.tanh(x @ self.fc2_weight.T + self.fc2_bias)
+
+    def state_dict(self):
+        return {
+            "fc1.weight": self.fc1_weight,
+            "fc1.bias": self.fc1_bias,
+            "fc2.weight": self.fc2_weight,
+            "fc2.bias": self.fc2_bias,
+        }
+
+    def to_vector(self):
+        return np.concatenate([v.ravel() for v in self.state_dict().values()])
+
+    def from_vector(self, vector):
+        # a control with this one's layer sizes and the given flat parameters
+        arrays = []
+        start = 0
+        for value in self.state_dict().values():
+            arrays.append(np.reshape(vector[start:start + value.size], value.shape))
+            start += value.size
+        return NumpyMotorControl(*arrays)
+
+    @staticmethod
+    def from_state_dict(state):
+        state = {k: np.asarray(v.detach().cpu().numpy() if hasattr(v, "detach") else v) for k, v in state.items()}
+        return NumpyMotorControl(state["fc1.weight"], state["fc1.bias"], state["fc2.weight"], state["fc2.bias"])
+
+    def save(self, path):
+        meta = {"format": "motor_control", "version": FORMAT_VERSION, "activations": ["relu", "tanh"]}
+        write_pack(path, self.state_dict(), meta)
+
+    @staticmethod
+    def load(path):
+        arrays, meta = read_pack(path)
+        if meta.get("format") != "motor_control" or meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} motor control file")
+        return NumpyMotorControl.from_state_dict(arrays)
+
+
+class TorchForward:
+    def __init__(self, model):
+        import torch
+        self.torch = torch
+        self.model = model.eval()
+        self.input_size = model.fc1.in_features
+        self.output_size = model.fc2.out_features
+
+    def __call__(self, x):
+        with self.torch.inference_mode():
+            return self.model(self.torch.from_numpy(np.ascontiguousarray(x))).numpy()
+
+
+class MotorInference:
+    def __init__(self, forward, output_columns=3, cache_size=CACHE_SIZE, quantum=QUANTUM):
+        self.forward = forward
+        self.output_columns = output_columns
+        self.cache_size = cache_size
+        self.quantum = quantum
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, map):
+        return self.predict(np.asarray(map)[None])[0]
+
+    def quantize(self, flat):
+        return np.round(flat / self.quantum).astype(np.int32)
+
+    def predict(self, maps):
+        flat = flatten_maps(maps)
+        if self.cache_size <= 0:
+            return unflatten_maps(self.forward(flat), self.output_columns)
+
+        codes = self.quantize(flat)
+        keys = [row.tobytes() for row in codes]
+        out = np.empty((len(flat), self.forward.output_size), dtype=np.float32)
+
+        missing = {}
+        for i, key in enumerate(keys):
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                out[i] = cached
+                self.hits += 1
+            else:
+                missing.setdefault(key, []).append(i)
+
+        if missing:
+            first = [rows[0] for rows in missing.values()]
+            result = self.forward((codes[first] * self.quantum).astype(np.float32))
+            for (key, rows), row in zip(missing.items(), result):
+                out[rows] = row
+                self.cache[key] = row
+                self.misses += 1
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return unflatten_maps(out, self.output_columns)
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def load(path, **kwargs):
+        if is_pack(path):
+            return MotorInference(NumpyMotorControl.load(path), **kwargs)
+
+        import torch
+        from learning.motor_control import MotorControl
+        state = torch.load(path, weights_only=True)
+        hidden_size, input_size = state["fc1.weight"].shape
+        model = MotorControl(input_size, hidden_size, state["fc2.weight"].shape[0])
+        model.load_state_dict(state)
+        return MotorInference(TorchForward(model), **kwargs)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export a MotorControl state dict to a NumPy forward path")
+    parser.add_argument("model", help="torch state dict, e.g. learning/model.pt")
+    parser.add_argument("out", help="output .pack file")
+    args = parser.parse_args()
+
+    import torch
+    NumpyMotorControl.from_state_dict(torch.load(args.model, weights_only=True)).save(args.out)
@@ -5,7 +5,7 @@ hidden_size = 16
 output_size = 14 * 3
 
 class MotorControl(Module):
-    def __init__(self):
+    def __init__(self, input_size=input_size, hidden_size=hidden_size, output_size=output_size):
         super(MotorControl, self).__init__()
         self.fc1 = Linear(input_size , hidden_size)
         self.relu1 = ReLU()
@@ -17,6 +17,9 @@ class MotorControl(Module):
         x = self.tanh(self.fc2(x))
         return x
 
+def for_config(config, hidden_size=hidden_size):
+    return MotorControl(config.brain_input_size, hidden_size, config.brain_output_size)
+
 if __name__ == "__main__":
     net = MotorControl() 
     print(net)
\ No newline at end of file
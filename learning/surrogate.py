@@ -0,0 +1,410 @@
+import time
+
+import numpy as np
+
+import simulation
+from hydra import HydraConfig
+from mass_spring import MassSpringHydras
+from packfile import write_pack, read_pack
+from rollout import batch_rollout
+
+FORMAT_VERSION = 1
+DT = 1 / 60
+STRIDE = 1
+AMPLITUDE = 1
+
+
+def rest_state(config):
+    # the dynamic cells and their positions before the first step
+    sim = simulation.Simulation(config)
+    sim.createHydra()
+    state = sim.hydra.state
+    return state.dynamic, state.gather()[state.dynamic], sim.hydra.muscle_bank.n_muscles
+
+
+def features(position, velocity, activation, pressure, rest):
+    # position and velocity are (..., n_dynamic, 2); activation is averaged over the surrogate step
+    lead = position.shape[:-2]
+    return np.concatenate([(position - rest).reshape(lead + (-1,)), velocity.reshape(lead + (-1,)),
+                           activation, np.asarray(pressure)[..., None]], axis=-1)
+
+
+def transitions(trajectory, dynamic, rest, n_muscles, stride=STRIDE):
+    # pairs of (state, stride steps later) from one recorded rollout, starting from the rest state
+    positions = np.concatenate([rest[None], trajectory["positions"][:, dynamic]])
+    velocities = np.concatenate([np.zeros((1,) + rest.shape), trajectory["velocities"][:, dynamic]])
+    # the activation recorded after step i drives the muscles during step i + 1
+    activation = np.concatenate([np.zeros((1, n_muscles)), trajectory["activation"]])
+    pressure = np.concatenate([[0], trajectory["pressure"]])
+
+    steps = (len(positions) - 1) // stride
+    start = np.arange(steps) * stride
+    end = start + stride
+    mean_activation = activation[:steps * stride].reshape(steps, stride, n_muscles).mean(axis=1)
+    inputs = features(positions[start], velocities[start], mean_activation, pressure[start], rest)
+    targets = np.concatenate([(positions[end] - positions[start]).reshape(steps, -1),
+                              (velocities[end] - velocities[start]).reshape(steps, -1),
+                              pressure[end, None]], axis=-1)
+    return inputs.astype(np.float32), targets.astype(np.float32)
+
+
+def random_maps(count, shape, amplitude=AMPLITUDE, seed=0):
+    # uniform maps, each scaled by its own amplitude so weak and strong contractions are both covered
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-1, 1, (count,) + tuple(shape)) * rng.uniform(0, amplitude, (count, 1, 1))
+
+
+def collect(out, rollouts=256, duration=5, dt=DT, stride=STRIDE, amplitude=AMPLITUDE, seed=0, processes=None):
+    config = HydraConfig()
+    dynamic, rest, n_muscles = rest_state(config)
+    maps = random_maps(rollouts, config.muscle_shape, amplitude, seed)
+    results, stats = batch_rollout(maps, "muscle", duration, dt, seed=seed, processes=processes, record=True,
+                                   config=config)
+
+    inputs = []
+    targets = []
+    exploded = 0
+    for result in results:
+        if "EXPLODING" in result["trajectory"]["status"]:
+            exploded += 1
+            continue
+        x, y = transitions(result["trajectory"], dynamic, rest, n_muscles, stride)
+        inputs.append(x)
+        targets.append(y)
+    if not inputs:
+        raise ValueError(f"all {rollouts} rollouts exploded; lower --amplitude or --dt")
+
+    meta = {"format": "surrogate_dataset", "version": FORMAT_VERSION, "height": config.height, "dt": dt,
+            "stride": stride, "duration": duration, "rollouts": len(inputs), "exploded": exploded}
+    write_pack(out, {"inputs": np.concatenate(inputs), "targets": np.concatenate(targets)}, meta)
+    print(f"Saved {sum(len(x) for x in inputs)} transitions from {len(inputs)} rollouts to {out} "
+          f"({exploded} exploded rollouts dropped, {stats['throughput']:.1f} simulated s per wall s)")
+    return meta
+
+
+class NumpyDynamics:
+    # a trained DynamicsModel with its normalization: raw features in, raw state change and next pressure out
+
+    def __init__(self, weights, biases, input_mean, input_std, target_mean, target_std, height, dt, stride):
+        self.weights = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+        self.biases = [np.ascontiguousarray(b, dtype=np.float32) for b in biases]
+        self.input_mean = np.asarray(input_mean, dtype=np.float32)
+        self.input_std = np.asarray(input_std, dtype=np.float32)
+        self.target_mean = np.asarray(target_mean, dtype=np.float32)
+        self.target_std = np.asarray(target_std, dtype=np.float32)
+        self.height = height
+        self.dt = dt
+        self.stride = stride
+
+    def __call__(self, x):
+        x = ((x - self.input_mean) / self.input_std).astype(np.float32)
+        for weight, bias in zip(self.weights[:-1], self.biases[:-1]):
+            x = np.maximum(x @ weight.T + bias, 0)
+        x = x @ self.weights[-1].T + self.biases[-1]
+        return x * self.target_std + self.target_mean
+
+    def state_dict(self):
+        state = {"input_mean": self.input_mean, "input_std": self.input_std,
+                 "target_mean": self.target_mean, "target_std": self.target_std}
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            state[f"layers.{i}.weight"] = weight
+            state[f"layers.{i}.bias"] = bias
+        return state
+
+    @staticmethod
+    def from_state_dict(state, height, dt, stride):
+        state = {k: np.asarray(v.detach().cpu().numpy() if hasattr(v, "detach") else v) for k, v in state.items()}
+        n_layers = sum(1 for k in state if k.startswith("layers.") and k.endswith(".weight"))
+        return NumpyDynamics([state[f"layers.{i}.weight"] for i in range(n_layers)],
+                             [state[f"layers.{i}.bias"] for i in range(n_layers)],
+                             state["input_mean"], state["input_std"], state["target_mean"], state["target_std"],
+                             height, dt, stride)
+
+    def save(self, path):
+        meta = {"format": "hydra_surrogate", "version": FORMAT_VERSION, "activations": ["relu", "linear"],
+                "height": self.height, "dt": self.dt, "stride": self.stride}
+        write_pack(path, self.state_dict(), meta)
+
+    @staticmethod
+    def load(path):
+        arrays, meta = read_pack(path)
+        if meta.get("format") != "hydra_surrogate" or meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} hydra surrogate")
+        return NumpyDynamics.from_state_dict(arrays, meta["height"], meta["dt"], meta["stride"])
+
+
+class SurrogateHydras(MassSpringHydras):
+    # a batch of hydras stepped through the learned model; activations still follow the exact bank dynamics
+
+    def __init__(self, model, batch, config=None):
+        super().__init__(batch, HydraConfig(model.height) if config is None else config)
+        self.model = model
+        self.step_size = model.dt * model.stride
+        self.dynamic = self.state.dynamic
+        self.rest = self.position[0, self.dynamic].copy()
+
+    def advance(self, dt=None, substeps=1):
+        # one model step; dt and substeps are fixed by the model
+        bank = self.bank
+        activation = np.zeros(bank.activation.shape)
+        for _ in range(self.model.stride):
+            activation += bank.activation
+            bank.step_excitation(self.model.dt)
+        activation /= self.model.stride
+
+        position = self.position[:, self.dynamic]
+        velocity = self.velocity[:, self.dynamic]
+        with np.errstate(all="ignore"):
+            change = self.model(features(position, velocity, activation, self.pressure, self.rest))
+        size = position[0].size
+        self.position[:, self.dynamic] = position + change[:, :size].reshape(position.shape)
+        self.velocity[:, self.dynamic] = velocity + change[:, size:2 * size].reshape(velocity.shape)
+        self.pressure = change[:, -1].astype(np.float64)
+        self.time += self.step_size
+
+    def run(self, duration, dt=None, substeps=1, record=True):
+        n_steps = int(round(duration / self.step_size))
+        positions = np.zeros((n_steps, self.batch, self.n_cells, 2)) if record else None
+        for i in range(n_steps):
+            self.advance()
+            if record:
+                positions[i] = self.position
+        return positions
+
+
+def rank_correlation(a, b):
+    # over the entries finite in both, since argsort ranks NaNs arbitrarily
+    finite = np.isfinite(a) & np.isfinite(b)
+    if finite.sum() < 2:
+        return float("nan")
+    ranks_a = np.argsort(np.argsort(a[finite]))
+    ranks_b = np.argsort(np.argsort(b[finite]))
+    return float(np.corrcoef(ranks_a, ranks_b)[0, 1])
+
+
+def report(model, maps, duration=5, processes=1):
+    # surrogate against pymunk on the same maps; processes=1 keeps the throughput comparison per core
+    maps = np.asarray(maps, dtype=np.float64)
+    start = time.perf_counter()
+    results, _ = batch_rollout(maps, "muscle", duration, model.dt, processes=processes, record=True,
+                               config=HydraConfig(model.height))
+    pymunk_wall = time.perf_counter() - start
+
+    surrogate = SurrogateHydras(model, len(maps))
+    surrogate.play_excitation(maps)
+    start = time.perf_counter()
+    positions = surrogate.run(duration)
+    surrogate_wall = time.perf_counter() - start
+
+    reference = np.stack([r["trajectory"]["positions"] for r in results], axis=1)
+    reference = reference[model.stride - 1::model.stride][:len(positions)]
+    error = np.linalg.norm(positions[:len(reference)] - reference, axis=-1)
+    summary = surrogate.summarize()
+    head = np.array([r["head"] for r in results])
+    length = np.array([r["length"] for r in results])
+    displacement = np.array([r["head_displacement"] for r in results])
+    return {
+        "maps": len(maps),
+        "max_error": float(np.nanmax(error)) if np.isfinite(error).any() else float("nan"),
+        "final_rms_error": float(np.sqrt((error[-1] ** 2).mean())),
+        "head_error": float(np.linalg.norm(summary["head"] - head, axis=-1).mean()),
+        "length_error": float(np.abs(summary["length"] - length).mean()),
+        "displacement_rank_correlation": rank_correlation(summary["head_displacement"], displacement),
+        "diverged": int((~np.isfinite(error[-1])).any(axis=-1).sum()),
+        "pymunk_seconds_per_sec": len(maps) * duration / pymunk_wall,
+        "surrogate_seconds_per_sec": len(maps) * duration / surrogate_wall,
+    }
+
+
+def screen(model, maps, objective="head", target=(0, 300), keep=16, duration=5, processes=None, cache=None):
+    # rank by surrogate cost, confirm the best keep with physics; returns indices, physics and surrogate costs
+    from optimizer import score
+
+    maps = np.asarray(maps, dtype=np.float64)
+    surrogate = SurrogateHydras(model, len(maps))
+    surrogate.play_excitation(maps)
+    surrogate.run(duration, record=False)
+    summary = surrogate.summarize()
+    predicted = np.array([score({"head": summary["head"][i], "length": summary["length"][i]}, objective, target)
+                          for i in range(len(maps))])
+
+    candidates = np.argsort(predicted, kind="stable")[:keep]
+    results, _ = batch_rollout(maps[candidates], "muscle", duration, model.dt, processes=processes,
+                               record=False, cache=cache, config=HydraConfig(model.height))
+    confirmed = np.array([score(result, objective, target) for result in results])
+    order = np.argsort(confirmed, kind="stable")
+    return candidates[order], confirmed[order], predicted[candidates[order]]
+
+
+def normalization(values):
+    mean = values.mean(axis=0)
+    std = values.std(axis=0)
+    # constant columns, e.g. never used muscles, pass through unscaled
+    std[std < 1e-6] = 1
+    return mean, std
+
+
+def train(data="learning/surrogate_data.pack", out="learning/surrogate.pt", epochs=200, batch_size=256, lr=1e-3,
+          hidden_size=None, n_hidden=None, val_split=0.1, patience=20, threads=None, seed=0, log_every=1):
+    import torch
+    import torch.nn as nn
+    import torch.optim as optim
+
+    from learning import dynamics
+    from learning.train import split
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    generator = torch.Generator().manual_seed(seed)
+
+    arrays, meta = read_pack(data)
+    if meta.get("format") != "surrogate_dataset":
+        raise ValueError(f"{data} is not a surrogate dataset")
+    train_idx, val_idx = split(len(arrays["inputs"]), val_split, generator)
+    input_mean, input_std = normalization(np.asarray(arrays["inputs"])[train_idx.numpy()])
+    target_mean, target_std = normalization(np.asarray(arrays["targets"])[train_idx.numpy()])
+    inputs = torch.from_numpy((np.asarray(arrays["inputs"]) - input_mean) / input_std)
+    targets = torch.from_numpy((np.asarray(arrays["targets"]) - target_mean) / target_std)
+
+    model = dynamics.DynamicsModel(inputs.shape[-1], targets.shape[-1],
+                                   hidden_size or dynamics.hidden_size, n_hidden or dynamics.n_hidden)
+    criterion = nn.MSELoss()
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+
+    best = float("inf")
+    best_epoch = 0
+    best_state = None
+    for epoch in range(epochs):
+        start = time.perf_counter()
+        model.train()
+        total = 0
+        order = train_idx[torch.randperm(len(train_idx), generator=generator)]
+        for first in range(0, len(order), batch_size):
+            batch = order[first:first + batch_size]
+            loss = criterion(model(inputs[batch]), targets[batch])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(batch)
+        elapsed = time.perf_counter() - start
+
+        train_loss = total / len(train_idx)
+        model.eval()
+        with torch.inference_mode():
+            val_loss = criterion(model(inputs[val_idx]), targets[val_idx]).item() if len(val_idx) else float("nan")
+        monitored = val_loss if len(val_idx) else train_loss
+        if monitored < best:
+            best = monitored
+            best_epoch = epoch
+            best_state = {k: v.clone() for k, v in model.state_dict().items()}
+            torch.save(best_state, out)
+
+        if log_every and epoch % log_every == 0:
+            print(f"Epoch {epoch} loss: {train_loss:.6f} val: {val_loss:.6f} "
+                  f"time: {elapsed * 1000:.1f}ms ({len(train_idx) / elapsed:.0f} samples/s)")
+
+        if epoch - best_epoch >= patience:
+            print(f"Early stopping at epoch {epoch}, best epoch {best_epoch}")
+            break
+
+    if best_state is None:
+        raise ValueError("the loss was never finite; lower --lr or check the dataset for non-finite values")
+    best_state.update(input_mean=input_mean, input_std=input_std, target_mean=target_mean, target_std=target_std)
+    exported = out.rsplit(".", 1)[0] + ".pack"
+    NumpyDynamics.from_state_dict(best_state, meta["height"], meta["dt"], meta["stride"]).save(exported)
+    print(f"Best loss {best:.6f} at epoch {best_epoch}, saved to {out} and {exported}")
+    return best
+
+
+if __name__ == "__main__":
+    import argparse
+    import glob
+    import json
+
+    from activation_map import ActivationMap
+
+    parser = argparse.ArgumentParser(description="Learned surrogate dynamics for fast approximate rollouts")
+    commands = parser.add_subparsers(dest="command", required=True)
+    collect_parser = commands.add_parser("collect", help="record pymunk rollouts of random muscle maps")
+    collect_parser.add_argument("out", nargs="?", default="learning/surrogate_data.pack")
+    collect_parser.add_argument("--rollouts", type=int, default=256)
+    collect_parser.add_argument("--duration", type=float, default=5)
+    collect_parser.add_argument("--dt", type=float, default=DT)
+    collect_parser.add_argument("--stride", type=int, default=STRIDE, help="physics steps per surrogate step")
+    collect_parser.add_argument("--amplitude", type=float, default=AMPLITUDE)
+    collect_parser.add_argument("--seed", type=int, default=0)
+    collect_parser.add_argument("--processes", type=int, default=None)
+    train_parser = commands.add_parser("train")
+    train_parser.add_argument("data", nargs="?", default="learning/surrogate_data.pack")
+    train_parser.add_argument("out", nargs="?", default="learning/surrogate.pt")
+    train_parser.add_argument("--epochs", type=int, default=200)
+    train_parser.add_argument("--batch-size", type=int, default=256)
+    train_parser.add_argument("--lr", type=float, default=1e-3)
+    train_parser.add_argument("--hidden-size", type=int, default=None)
+    train_parser.add_argument("--layers", type=int, default=None, help="number of hidden layers")
+    train_parser.add_argument("--val-split", type=float, default=0.1)
+    train_parser.add_argument("--patience", type=int, default=20)
+    train_parser.add_argument("--threads", type=int, default=None)
+    train_parser.add_argument("--seed", type=int, default=0)
+    train_parser.add_argument("--log-every", type=int, default=1)
+    report_parser = commands.add_parser("report", help="compare the surrogate against pymunk rollouts")
+    report_parser.add_argument("model", nargs="?", default="learning/surrogate.pack")
+    report_parser.add_argument("--maps", default="learning/data/*.out", help="muscle maps to compare on")
+    report_parser.add_argument("--random", type=int, default=64, help="random maps to add to them")
+    report_parser.add_argument("--duration", type=float, default=5)
+    report_parser.add_argument("--processes", type=int, default=1)
+    report_parser.add_argument("--json", default=None, help="write results to this file")
+    screen_parser = commands.add_parser("screen", help="pre-filter random maps and confirm the best with pymunk")
+    screen_parser.add_argument("model", nargs="?", default="learning/surrogate.pack")
+    screen_parser.add_argument("--objective", choices=["head", "length"], default="head")
+    screen_parser.add_argument("--target", type=float, nargs="+", default=[0, 300])
+    screen_parser.add_argument("--candidates", type=int, default=1024)
+    screen_parser.add_argument("--keep", type=int, default=16)
+    screen_parser.add_argument("--duration", type=float, default=5)
+    screen_parser.add_argument("--seed", type=int, default=0)
+    screen_parser.add_argument("--processes", type=int, default=None)
+    screen_parser.add_argument("--cache", default=None, help="directory of cached rollout results to reuse")
+    screen_parser.add_argument("--out", default=None, help=".out map to save the best confirmed map to")
+    args = parser.parse_args()
+
+    if args.command == "collect":
+        collect(args.out, args.rollouts, args.duration, args.dt, args.stride, args.amplitude, args.seed,
+                args.processes)
+    elif args.command == "train":
+        train(args.data, args.out, args.epochs, args.batch_size, args.lr, args.hidden_size, args.layers,
+              args.val_split, args.patience, args.threads, args.seed, args.log_every)
+    elif args.command == "report":
+        model = NumpyDynamics.load(args.model)
+        config = HydraConfig(model.height)
+        maps = []
+        for path in sorted(glob.glob(args.maps)):
+            amap = ActivationMap(config.muscle_shape, (0, 0), 0)
+            amap.load_map(path)
+            maps.append(amap.map.copy())
+        maps = np.concatenate([np.reshape(maps, (-1,) + config.muscle_shape),
+                               random_maps(args.random, config.muscle_shape, seed=1)])
+        results = report(model, maps, args.duration, args.processes)
+        print(f"Over {results['maps']} maps, {args.duration:g}s: max error {results['max_error']:.3f}, "
+              f"final RMS error {results['final_rms_error']:.3f}, head error {results['head_error']:.3f}, "
+              f"length error {results['length_error']:.3f}, {results['diverged']} diverged")
+        print(f"Head displacement rank correlation {results['displacement_rank_correlation']:.3f}")
+        print(f"Throughput {results['surrogate_seconds_per_sec']:.1f} simulated s per wall s against "
+              f"{results['pymunk_seconds_per_sec']:.1f} for pymunk "
+              f"({results['surrogate_seconds_per_sec'] / results['pymunk_seconds_per_sec']:.1f}x)")
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+    else:
+        model = NumpyDynamics.load(args.model)
+        config = HydraConfig(model.height)
+        maps = random_maps(args.candidates, config.muscle_shape, seed=args.seed)
+        index, confirmed, predicted = screen(model, maps, args.objective, args.target, args.keep, args.duration,
+                                             args.processes, args.cache)
+        for i, cost, guess in zip(index, confirmed, predicted):
+            print(f"map {i}: cost {cost:.3f} (surrogate {guess:.3f})")
+        if args.out is not None:
+            amap = ActivationMap(config.muscle_shape, (0, 0), 0)
+            amap.map[:] = np.clip(maps[index[0]], -1, 1)
+            amap.save_map(args.out)
+            print(f"Saved to {args.out}")
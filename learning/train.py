@@ -0,0 +1,108 @@
+import time
+from os import path, listdir
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from learning.motor_control import MotorControl
+from learning.dataset import MotorDataset, pack_dataset
+from learning.inference import NumpyMotorControl
+
+
+def ensure_pack(src):
+    if not path.isdir(src):
+        return src
+    out = src.rstrip("/") + ".pack"
+    newest = max(path.getmtime(path.join(src, f)) for f in listdir(src))
+    if not path.exists(out) or path.getmtime(out) < newest:
+        pack_dataset(src, out)
+    return out
+
+
+def split(n, val_split, generator):
+    order = torch.randperm(n, generator=generator)
+    n_val = int(round(n * val_split)) if n > 1 else 0
+    return order[n_val:], order[:n_val]
+
+
+def evaluate(model, criterion, ds, indices):
+    if len(indices) == 0:
+        return float("nan")
+    model.eval()
+    with torch.inference_mode():
+        return criterion(model(ds.inputs[indices]), ds.targets[indices]).item()
+
+
+def train(data="learning/data", out="learning/model.pt", epochs=1000, batch_size=8, lr=0.01, momentum=0.9,
+          val_split=0.2, patience=100, threads=None, seed=0, init=None, log_every=1):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    generator = torch.Generator().manual_seed(seed)
+
+    ds = MotorDataset(ensure_pack(data))
+    train_idx, val_idx = split(len(ds), val_split, generator)
+
+    model = MotorControl(ds.inputs.shape[-1], output_size=ds.targets.shape[-1])
+    if init is not None:
+        model.load_state_dict(torch.load(init, weights_only=True))
+    criterion = nn.MSELoss()
+    optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum)
+
+    best = float("inf")
+    best_epoch = 0
+    for epoch in range(epochs):
+        start = time.perf_counter()
+        model.train()
+        total = 0
+        for input, target in ds.batches(batch_size, generator=generator, indices=train_idx):
+            loss = criterion(model(input), target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(input)
+        elapsed = time.perf_counter() - start
+
+        train_loss = total / len(train_idx)
+        val_loss = evaluate(model, criterion, ds, val_idx)
+        monitored = val_loss if len(val_idx) else train_loss
+        if monitored < best:
+            best = monitored
+            best_epoch = epoch
+            torch.save(model.state_dict(), out)
+
+        if log_every and epoch % log_every == 0:
+            print(f"Epoch {epoch} loss: {train_loss:.6f} val: {val_loss:.6f} "
+                  f"time: {elapsed * 1000:.1f}ms ({len(train_idx) / elapsed:.0f} samples/s)")
+
+        if epoch - best_epoch >= patience:
+            print(f"Early stopping at epoch {epoch}, best epoch {best_epoch}")
+            break
+
+    exported = path.splitext(out)[0] + ".pack"
+    NumpyMotorControl.from_state_dict(torch.load(out, weights_only=True)).save(exported)
+    print(f"Best loss {best:.6f} at epoch {best_epoch}, saved to {out} and {exported}")
+    return best
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Train the MotorControl MLP")
+    parser.add_argument("--data", default="learning/data", help="data directory or packed dataset")
+    parser.add_argument("--out", default="learning/model.pt")
+    parser.add_argument("--init", default=None, help="state dict to start from")
+    parser.add_argument("--epochs", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--momentum", type=float, default=0.9)
+    parser.add_argument("--val-split", type=float, default=0.2)
+    parser.add_argument("--patience", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-every", type=int, default=10)
+    args = parser.parse_args()
+
+    train(args.data, args.out, args.epochs, args.batch_size, args.lr, args.momentum, args.val_split,
+          args.patience, args.threads, args.seed, args.init, args.log_every)
@@ -0,0 +1,220 @@
+import math
+
+import numpy as np
+import pymunk
+
+from hydra import Hydra, HydraConfig
+from hydra_state import PRESSURE_THRESHOLD
+from cell import CELL_RADIUS
+from simulation import PLATFORM_SIZE, FLOOR_RADIUS, SPACE_DAMPING
+
+# pymunk's defaults, so both backends solve the same number of passes with the same bias
+ITERATIONS = 10
+ERROR_BIAS = math.pow(1 - 0.1, 60)
+
+
+def color_edges(a, b):
+    # greedy edge coloring: springs of one color share no cell, so each color updates in one vectorized pass
+    colors = []
+    used = []
+    for i, (u, v) in enumerate(zip(a.tolist(), b.tolist())):
+        for color, cells in zip(colors, used):
+            if u not in cells and v not in cells:
+                color.append(i)
+                cells.update((u, v))
+                break
+        else:
+            colors.append([i])
+            used.append({u, v})
+    return [np.array(color, dtype=np.intp) for color in colors]
+
+
+class MassSpringHydras:
+    # identical hydras in (batch, n_cells, 2) arrays, stepped like pymunk but solving each spring color at once
+    def __init__(self, batch, config=None, iterations=ITERATIONS, damping=SPACE_DAMPING):
+        self.config = config = HydraConfig() if config is None else config
+        # the template only supplies topology, masses and spring constants; it never steps
+        space = pymunk.Space()
+        template = Hydra(space, config=config)
+        state = template.state
+        muscles = template.endoderm_muscles + template.ectoderm_muscles
+
+        self.batch = batch
+        self.iterations = iterations
+        self.damping = damping
+        self.state = state
+        self.n_cells = state.n_cells
+        self.time = 0
+        self.excitation_index = template.excitation_index
+        self.bulk_modulus = config.bulk_modulus
+        self.excitation_duration = config.excitation_duration
+
+        self.inv_mass = np.array([1 / body.mass if body.body_type == body.DYNAMIC else 0
+                                  for body in state.bodies])
+        self.a = state.muscle_a
+        self.b = state.muscle_b
+        self.rest_length = np.array([m.joint.rest_length for m in muscles])
+        self.stiffness = np.array([m.joint.stiffness for m in muscles])
+        self.spring_damping = np.array([m.joint.damping for m in muscles])
+        self.k = self.inv_mass[self.a] + self.inv_mass[self.b]
+        self.n_mass = 1 / self.k
+        # maps per-spring impulses onto the velocity change of each cell
+        springs = np.arange(len(muscles))
+        self.incidence = np.zeros((self.n_cells, len(muscles)))
+        self.incidence[self.a, springs] -= self.inv_mass[self.a]
+        self.incidence[self.b, springs] += self.inv_mass[self.b]
+        self.colors = color_edges(self.a, self.b)
+        self.pin = state.roof
+        self.pin_distance = template.pin.distance
+        self.pin_impulse = np.zeros(batch)
+
+        self.bank = template.muscle_bank.batched(batch)
+        pos = state.gather()
+        self.area = state.calc_area(pos)
+        self.original_head_pos = pos[self.pin].mean(axis=0)
+        self.position = np.repeat(pos[None], batch, axis=0)
+        self.velocity = np.zeros((batch, self.n_cells, 2))
+        self.forces = np.zeros((batch, self.n_cells, 2))
+        self.pressure = np.zeros(batch)
+
+    def play_excitation(self, maps, duration=None):
+        if duration is None:
+            duration = self.excitation_duration
+        self.bank.excite(self.excitation_index, maps, duration)
+
+    def advance(self, dt, substeps=1):
+        h = dt / substeps
+        for _ in range(substeps):
+            self.step_space(h)
+            self.step_hydras(h)
+            self.time += h
+
+    def step_space(self, dt):
+        p = self.position
+        p += self.velocity * dt
+
+        # the solver works cell-major, (n_cells, 2, batch), so gathering a spring's cells copies whole rows
+        inv = self.inv_mass[:, None, None]
+        pt = np.ascontiguousarray(p.transpose(1, 2, 0))
+        v = np.ascontiguousarray(self.velocity.transpose(1, 2, 0))
+
+        delta = pt[self.b] - pt[self.a]
+        dist = np.sqrt((delta ** 2).sum(axis=1))
+        n = delta / dist[:, None]
+        j = n * ((self.rest_length[:, None] - dist) * self.stiffness[:, None] * dt)[:, None]
+        v += (self.incidence @ j.reshape(len(j), -1)).reshape(v.shape)
+
+        v *= self.damping ** dt
+        v += self.forces.transpose(1, 2, 0) * inv * dt
+
+        v_coef = (1 - np.exp(-self.spring_damping * dt * self.k))[:, None]
+        colors = [(self.a[c], self.b[c], n[c], v_coef[c], self.n_mass[c, None], inv[self.a[c]], inv[self.b[c]],
+                   np.zeros((len(c), self.batch))) for c in self.colors]
+
+        pa, pb = self.pin
+        pin_delta = pt[pb] - pt[pa]
+        pin_dist = np.sqrt((pin_delta ** 2).sum(axis=0))
+        pin_n = pin_delta / pin_dist
+        inv_a, inv_b = self.inv_mass[pa], self.inv_mass[pb]
+        pin_bias = -(1 - ERROR_BIAS ** dt) * (pin_dist - self.pin_distance) / dt
+        v[pa] -= pin_n * self.pin_impulse * inv_a
+        v[pb] += pin_n * self.pin_impulse * inv_b
+
+        for _ in range(self.iterations):
+            for ca, cb, cn, coef, n_mass, ia, ib, target in colors:
+                vrn = ((v[cb] - v[ca]) * cn).sum(axis=1)
+                v_damp = (target - vrn) * coef
+                target[:] = vrn + v_damp
+                jc = cn * (v_damp * n_mass)[:, None]
+                v[ca] -= jc * ia
+                v[cb] += jc * ib
+
+            vrn = ((v[pb] - v[pa]) * pin_n).sum(axis=0)
+            jn = (pin_bias - vrn) / (inv_a + inv_b)
+            self.pin_impulse += jn
+            v[pa] -= pin_n * jn * inv_a
+            v[pb] += pin_n * jn * inv_b
+
+        self.velocity[:] = v.transpose(2, 0, 1)
+        self.collide_floor(dt)
+
+    def collide_floor(self, dt):
+        # inelastic, frictionless contact with the floor segment
+        p = self.position
+        v = self.velocity
+        depth = FLOOR_RADIUS + CELL_RADIUS - p[..., 1]
+        contact = (depth > 0) & (np.abs(p[..., 0]) <= PLATFORM_SIZE) & (self.inv_mass > 0)
+        if contact.any():
+            push = (1 - ERROR_BIAS ** dt) * depth / dt
+            v[..., 1] = np.where(contact, np.maximum(v[..., 1], push), v[..., 1])
+
+    def step_hydras(self, dt):
+        pos = self.position
+        forces = self.forces
+        forces.fill(0)
+        self.bank.step(pos, dt, forces)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.pressure = -self.bulk_modulus * np.log(self.state.calc_area(pos) / self.area)
+        pressure = np.where(self.pressure > PRESSURE_THRESHOLD, self.pressure, 0)
+        self.state.wall_forces(pos, pressure, dt, out=forces)
+
+    def run(self, duration, dt=1 / 60, substeps=1, record=True):
+        n_steps = int(round(duration / dt))
+        positions = np.zeros((n_steps, self.batch, self.n_cells, 2)) if record else None
+        for i in range(n_steps):
+            self.advance(dt, substeps)
+            if record:
+                positions[i] = self.position
+        return positions
+
+    def head(self):
+        return self.position[:, self.pin].mean(axis=1)
+
+    def length(self):
+        left, right = self.state.left, self.state.right
+        pa, pb = self.pin
+        diff1 = np.linalg.norm(self.position[:, left[0]] - self.position[:, pa], axis=-1)
+        diff2 = np.linalg.norm(self.position[:, right[0]] - self.position[:, pb], axis=-1)
+        return (diff1 + diff2) / 2
+
+    def summarize(self):
+        head = self.head()
+        return {
+            "length": self.length(),
+            "area": self.state.calc_area(self.position),
+            "pressure": self.pressure,
+            "head": head,
+            "head_displacement": np.linalg.norm(head - self.original_head_pos, axis=-1),
+        }
+
+
+class MassSpringBackend:
+    # stands in for the pymunk solver inside a Simulation: the hydras' bodies leave the space and
+    # mirror MassSpringHydras arrays, while muscles, pressure and control still run on the Hydra objects
+    def __init__(self, hydras, damping=SPACE_DAMPING):
+        self.hydras = list(hydras)
+        config = self.hydras[0].config
+        if any(vars(h.config) != vars(config) for h in self.hydras):
+            raise ValueError("the mass-spring backend needs every hydra to share one config")
+        self.batch = MassSpringHydras(len(self.hydras), config, damping=damping)
+        self.dynamic = self.hydras[0].state.dynamic
+        self.bodies = [h.state.bodies[i] for h in self.hydras for i in self.dynamic.tolist()]
+        # static base cells stay wherever each hydra was placed
+        self.batch.position[:] = [h.state.gather() for h in self.hydras]
+
+    def step(self, dt):
+        # only positions, velocities and the queued forces cross over; the cells never rotate
+        batch = self.batch
+        dynamic = self.dynamic
+        rows = np.array([(*b.position, *b.velocity, *b.force) for b in self.bodies]).reshape(batch.batch, -1, 6)
+        batch.position[:, dynamic] = rows[..., 0:2]
+        batch.velocity[:, dynamic] = rows[..., 2:4]
+        batch.forces[:, dynamic] = rows[..., 4:6]
+        batch.step_space(dt)
+        out = np.concatenate([batch.position[:, dynamic], batch.velocity[:, dynamic]], axis=-1)
+        for body, (x, y, vx, vy) in zip(self.bodies, out.reshape(-1, 4).tolist()):
+            body.position = x, y
+            body.velocity = vx, vy
+            # forces are used up by the step, as pymunk clears them
+            body.force = 0, 0
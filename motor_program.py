@@ -0,0 +1,180 @@
+import numpy as np
+
+from packfile import write_pack, read_pack
+
+FORMAT_VERSION = 1
+# maps live in [-1, 1] and are stored as int16 codes
+CODE_SCALE = 32767
+RESOLUTION = 1 / 240
+
+
+class MotorProgram:
+    # activation map keyframes, each held until the next one or blended towards it when interpolate is set
+    def __init__(self, times, maps, duration=None, loop=False, interpolate=False):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.maps = np.clip(np.asarray(maps, dtype=np.float64), -1, 1)
+        if self.maps.ndim != 3 or len(self.maps) != len(self.times) or len(self.times) == 0:
+            raise ValueError("a motor program needs one (segments, columns) map per keyframe time")
+        if self.times[0] != 0 or np.any(np.diff(self.times) <= 0):
+            raise ValueError("keyframe times must start at 0 and increase")
+        if duration is None:
+            # hold the last keyframe as long as the average keyframe
+            duration = self.times[-1] + (self.times[-1] / (len(self.times) - 1) if len(self.times) > 1 else 1)
+        if duration <= self.times[-1]:
+            raise ValueError("duration must end after the last keyframe")
+        self.duration = float(duration)
+        self.loop = loop
+        self.interpolate = interpolate
+
+    @property
+    def shape(self):
+        return self.maps.shape[1:]
+
+    @staticmethod
+    def rhythm(maps, period, loop=True, interpolate=False):
+        # one keyframe per period, cycling through maps
+        return MotorProgram(np.arange(len(maps)) * period, maps, len(maps) * period, loop, interpolate)
+
+    def encode(self):
+        # the first keyframe in full, then only the codes that changed from one keyframe to the next
+        codes = np.round(self.maps.reshape(len(self.maps), -1) * CODE_SCALE).astype(np.int16)
+        changed = codes[1:] != codes[:-1]
+        frame, index = np.nonzero(changed)
+        return {
+            "times": self.times,
+            "first": codes[0],
+            "counts": np.bincount(frame, minlength=len(codes) - 1).astype(np.uint32),
+            "indices": index.astype(np.uint16),
+            "values": codes[1:][frame, index],
+        }
+
+    @staticmethod
+    def decode(arrays, meta):
+        first = np.asarray(arrays["first"])
+        counts = np.asarray(arrays["counts"])
+        updates = np.zeros((len(counts) + 1, len(first)), dtype=np.int16)
+        updates[0] = first
+        frames = np.repeat(np.arange(1, len(updates)), counts)
+        updates[frames, arrays["indices"]] = arrays["values"]
+
+        # forward fill: every code comes from the last keyframe that changed it
+        source = np.zeros(updates.shape, dtype=np.intp)
+        source[frames, arrays["indices"]] = frames
+        np.maximum.accumulate(source, axis=0, out=source)
+        codes = np.take_along_axis(updates, source, axis=0)
+        maps = codes.reshape((len(codes),) + tuple(meta["shape"])) / CODE_SCALE
+        return MotorProgram(arrays["times"], maps, meta["duration"], meta["loop"], meta["interpolate"])
+
+    def save(self, path):
+        meta = {"format": "motor_program", "version": FORMAT_VERSION, "shape": list(self.shape),
+                "duration": self.duration, "loop": self.loop, "interpolate": self.interpolate}
+        write_pack(path, self.encode(), meta)
+
+    @staticmethod
+    def load(path):
+        arrays, meta = read_pack(path)
+        if meta.get("format") != "motor_program" or meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} motor program")
+        return MotorProgram.decode(arrays, meta)
+
+    def compile(self, index, n_muscles, scale, resolution=RESOLUTION):
+        # excitation rates per muscle; schedule row k covers [k, k + 1) * resolution and plays frames[schedule[k]]
+        flat = np.zeros((len(self.maps), n_muscles))
+        flat[:, np.asarray(index).ravel()] = self.maps.reshape(len(self.maps), -1) * scale
+
+        t = np.arange(int(np.ceil(self.duration / resolution))) * resolution
+        keyframe = np.searchsorted(self.times, t, side="right") - 1
+        if not self.interpolate:
+            return flat, keyframe.astype(np.int32)
+
+        ends = np.append(self.times[1:], self.duration)
+        following = keyframe + 1
+        following[following == len(flat)] = 0 if self.loop else len(flat) - 1
+        blend = ((t - self.times[keyframe]) / (ends[keyframe] - self.times[keyframe]))[:, None]
+        frames = flat[keyframe] * (1 - blend) + flat[following] * blend
+        return frames, np.arange(len(frames), dtype=np.int32)
+
+
+class ProgramPlayer:
+    # streams a compiled program into a hydra's muscles, touching only the entries whose value changes
+    def __init__(self, program, hydra, start=0, resolution=RESOLUTION, loop=None):
+        self.program = program
+        self.bank = hydra.muscle_bank
+        self.start = start
+        self.rate = 1 / resolution
+        self.loop = program.loop if loop is None else loop
+        self.muscles = np.asarray(hydra.excitation_index).ravel()
+        self.frames, self.schedule = program.compile(hydra.excitation_index, self.bank.n_muscles,
+                                                     1 / hydra.config.excitation_duration, resolution)
+        # what the player last wrote to each of its muscles
+        self.current = np.zeros(len(self.muscles))
+        self.last_time = None
+        self.finished = False
+
+    def step(self, time, dt):
+        row = int((time - self.start) * self.rate)
+        if row < 0 or self.finished:
+            return
+        if row >= len(self.schedule):
+            if not self.loop:
+                self.stop()
+                return
+            row %= len(self.schedule)
+        if self.last_time is not None and time < self.last_time:
+            # the simulation was restored, so the bank may no longer hold what was written
+            self.current = self.bank.excitation[self.muscles].copy()
+        self.last_time = time
+
+        frame = self.frames[self.schedule[row]][self.muscles]
+        changed = np.flatnonzero(frame != self.current)
+        if len(changed):
+            values = frame[changed]
+            # held until the program changes them, released at once when they drop to zero
+            self.bank.drive(self.muscles[changed], values, np.where(values != 0, np.inf, 0))
+            self.current[changed] = values
+
+    def stop(self):
+        driven = np.flatnonzero(self.current)
+        self.bank.drive(self.muscles[driven], 0, 0)
+        self.current[driven] = 0
+        self.finished = True
+
+    def snapshot(self):
+        return self.current.copy(), self.last_time, self.finished
+
+    def restore(self, state):
+        current, self.last_time, self.finished = state
+        self.current = current.copy()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from activation_map import ActivationMap
+    from hydra import HydraConfig
+
+    parser = argparse.ArgumentParser(description="Build or inspect motor programs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="cycle through .out muscle maps, one per period")
+    build.add_argument("out")
+    build.add_argument("maps", nargs="+")
+    build.add_argument("--period", type=float, default=1)
+    build.add_argument("--loop", action="store_true")
+    build.add_argument("--interpolate", action="store_true")
+    info = commands.add_parser("info")
+    info.add_argument("program")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        maps = []
+        for path in args.maps:
+            amap = ActivationMap(HydraConfig().muscle_shape, (0, 0), 0)
+            amap.load_map(path)
+            maps.append(amap.map.copy())
+        program = MotorProgram.rhythm(maps, args.period, args.loop, args.interpolate)
+        program.save(args.out)
+        print(f"Saved {len(maps)} keyframes over {program.duration:g}s to {args.out}")
+    else:
+        program = MotorProgram.load(args.program)
+        print(f"{len(program.times)} keyframes of shape {program.shape} over {program.duration:g}s, "
+              f"loop {program.loop}, interpolate {program.interpolate}")
@@ -1,4 +1,7 @@
+import copy
+
 import pymunk
+import numpy as np
 
 MUSCLE_WIDTH = 2
 CELL_HEIGHT = 20
@@ -19,6 +22,8 @@ ECTODERM_COLOR = (0, 255, 0)
 MAX_STIFFNESS = max(ENDODERM_STIFFNESS, ECTODERM_STIFFNESS)
 
 EXCITATION_DECAY_RATE = 2
+ACTIVATION_CUTOFF = 0.0001
+CONTRACTION_GAIN = 20000
 
 class Muscle:
     def __init__(self, cell1, cell2, space, stiffness, damping, length, max_force, color):
@@ -32,24 +37,71 @@ class Muscle:
         self.stiffness = stiffness
         self.max_force = max_force
 
-        self.excitation_duration = 0
-        self.excitation = 0
-        self.activation = 0
+        self.bank = None
+        self.index = None
+        self._excitation_duration = 0
+        self._excitation = 0
+        self._activation = 0
 
-        joint1 = pymunk.DampedSpring(self.body1, self.body2,
+        self.joint = pymunk.DampedSpring(self.body1, self.body2,
                                             anchor_a=(0, 0), anchor_b=(0, 0),
                                             rest_length=length, stiffness=stiffness, damping=damping)
-        space.add(joint1)
+        space.add(self.joint)
+
+    @property
+    def excitation_duration(self):
+        if self.bank is not None:
+            return self.bank.excitation_duration[self.index]
+        return self._excitation_duration
+
+    @excitation_duration.setter
+    def excitation_duration(self, value):
+        if self.bank is not None:
+            self.bank.excitation_duration[self.index] = value
+            self.bank.wake(self.index)
+        else:
+            self._excitation_duration = value
 
+    @property
+    def excitation(self):
+        if self.bank is not None:
+            return self.bank.excitation[self.index]
+        return self._excitation
+
+    @excitation.setter
+    def excitation(self, value):
+        if self.bank is not None:
+            self.bank.excitation[self.index] = value
+            self.bank.wake(self.index)
+        else:
+            self._excitation = value
+
+    @property
+    def activation(self):
+        if self.bank is not None:
+            return self.bank.activation[self.index]
+        return self._activation
+
+    @activation.setter
+    def activation(self, value):
+        if self.bank is not None:
+            self.bank.activation[self.index] = value
+            self.bank.wake(self.index)
+        else:
+            self._activation = value
+
+    def line_width(self):
+        return int(MUSCLE_WIDTH * (self.stiffness / MAX_STIFFNESS))
 
     def draw(self, display):
-        width = int(MUSCLE_WIDTH * (self.stiffness / MAX_STIFFNESS))
-        display.draw_line(self.body1.position, self.body2.position, self.color, width)
+        display.draw_line(self.body1.position, self.body2.position, self.color, self.line_width())
 
     
     def step(self, steps_size):
+        if self.excitation == 0 and self.activation == 0:
+            return
         activation =self.step_excitation(steps_size)
-        force = -activation * self.max_force  * 20000
+        force = -activation * self.max_force  * CONTRACTION_GAIN
 
         self.body1.apply_force_at_local_point(self.muscle_vec() * force * steps_size, (0, 0))
         self.body2.apply_force_at_local_point(-self.muscle_vec() * force * steps_size, (0, 0))
@@ -58,6 +110,10 @@ class Muscle:
         self.excitation_duration = duration
         self.excitation += (excitation / duration)
 
+    def drive(self, excitation, duration):
+        self.excitation_duration = duration
+        self.excitation = excitation
+
     def step_excitation(self, steps_size):
         self.excitation_duration -= steps_size
         if self.excitation_duration < 0:
@@ -67,7 +123,7 @@ class Muscle:
         self.activation += self.excitation * steps_size
 
         self.activation -= self.activation * EXCITATION_DECAY_RATE * steps_size
-        if abs(self.activation) < 0.0001:
+        if abs(self.activation) < ACTIVATION_CUTOFF:
             self.activation = 0
         return self.activation
 
@@ -95,10 +151,114 @@ class Muscle:
             return False
 
 class EndodermMuscle(Muscle):
-    def __init__(self, cell1, cell2, space):
-        super().__init__(cell1, cell2, space, ENDODERM_STIFFNESS, ENDODERM_DAMPING, ENDODERM_LENGTH, ENDODERM_MAX_FORCE, ENDODERM_COLOR)
+    def __init__(self, cell1, cell2, space, stiffness=ENDODERM_STIFFNESS, damping=ENDODERM_DAMPING,
+                 length=ENDODERM_LENGTH, max_force=ENDODERM_MAX_FORCE):
+        super().__init__(cell1, cell2, space, stiffness, damping, length, max_force, ENDODERM_COLOR)
         
 class EctodermMuscle(Muscle):
-    def __init__(self, cell1, cell2, side, space):
-        super().__init__(cell1, cell2, space, ECTODERM_STIFFNESS, ECTODERM_DAMPING, ECTODERM_LENGTH, ECTODERM_MAX_FORCE, ECTODERM_COLOR)
-        self.side = side
\ No newline at end of file
+    def __init__(self, cell1, cell2, side, space, stiffness=ECTODERM_STIFFNESS, damping=ECTODERM_DAMPING,
+                 length=ECTODERM_LENGTH, max_force=ECTODERM_MAX_FORCE):
+        super().__init__(cell1, cell2, space, stiffness, damping, length, max_force, ECTODERM_COLOR)
+        self.side = side
+
+class MuscleBank:
+    def __init__(self, muscles, body_a, body_b, gain=CONTRACTION_GAIN, decay_rate=EXCITATION_DECAY_RATE):
+        self.muscles = list(muscles)
+        self.gain = gain
+        self.decay_rate = decay_rate
+        self.n_muscles = len(self.muscles)
+        self.body_a = np.asarray(body_a, dtype=np.intp)
+        self.body_b = np.asarray(body_b, dtype=np.intp)
+
+        self.max_force = np.array([m.max_force for m in self.muscles], dtype=np.float64)
+        self.excitation_duration = np.array([m.excitation_duration for m in self.muscles], dtype=np.float64)
+        self.excitation = np.array([m.excitation for m in self.muscles], dtype=np.float64)
+        self.activation = np.array([m.activation for m in self.muscles], dtype=np.float64)
+        # muscles that may still produce force; idle ones are skipped until something excites them
+        self.active = np.zeros(self.n_muscles, dtype=bool)
+        self.refresh()
+
+        for i, muscle in enumerate(self.muscles):
+            muscle.bank = self
+            muscle.index = i
+
+    def batched(self, batch):
+        # an independent copy whose state arrays have a leading batch axis, one row per hydra
+        bank = copy.copy(self)
+        bank.excitation_duration = np.tile(self.excitation_duration, (batch, 1))
+        bank.excitation = np.tile(self.excitation, (batch, 1))
+        bank.activation = np.tile(self.activation, (batch, 1))
+        bank.active = self.active.copy()
+        return bank
+
+    @property
+    def idle(self):
+        return not self.active.any()
+
+    def wake(self, index):
+        self.active[index] = True
+
+    def refresh(self):
+        # recompute the active set after the state arrays were written directly
+        busy = (self.excitation != 0) | (self.activation != 0)
+        self.active[:] = busy.reshape(-1, self.n_muscles).any(axis=0)
+
+    def active_index(self):
+        count = np.count_nonzero(self.active)
+        if count == 0:
+            return None
+        # gathering a large subset costs more than stepping everything
+        if count > self.n_muscles // 2:
+            return slice(None)
+        return np.flatnonzero(self.active)
+
+    def excite(self, index, excitation, duration):
+        self.excitation_duration[..., index] = duration
+        self.excitation[..., index] += np.asarray(excitation) / duration
+        self.active[index] = True
+
+    def drive(self, index, excitation, duration):
+        self.excitation_duration[..., index] = duration
+        self.excitation[..., index] = excitation
+        self.active[index] = True
+
+    def step_excitation(self, steps_size, active=None):
+        if active is None:
+            active = self.active_index()
+            if active is None:
+                return self.activation
+
+        duration = self.excitation_duration[..., active] - steps_size
+        excitation = self.excitation[..., active]
+        expired = duration < 0
+        duration[expired] = 0
+        excitation[expired] = 0
+
+        activation = self.activation[..., active]
+        activation += excitation * steps_size
+        activation -= activation * self.decay_rate * steps_size
+        activation[np.abs(activation) < ACTIVATION_CUTOFF] = 0
+
+        self.excitation_duration[..., active] = duration
+        self.excitation[..., active] = excitation
+        self.activation[..., active] = activation
+        busy = (excitation != 0) | (activation != 0)
+        self.active[active] = busy.reshape(-1, busy.shape[-1]).any(axis=0)
+        return self.activation
+
+    def step(self, pos, steps_size, out):
+        active = self.active_index()
+        if active is None:
+            return out
+        self.step_excitation(steps_size, active)
+
+        body_a = self.body_a[active]
+        body_b = self.body_b[active]
+        force = -self.activation[..., active] * self.max_force[active] * self.gain * steps_size
+
+        vec = pos[..., body_a, :] - pos[..., body_b, :]
+        vec /= np.linalg.norm(vec, axis=-1, keepdims=True)
+        vec *= force[..., None]
+        np.add.at(out, (..., body_a, slice(None)), vec)
+        np.subtract.at(out, (..., body_b, slice(None)), vec)
+        return out
@@ -1,23 +1,60 @@
 import random
+import numpy as np
 from muscle import Muscle
-import dill
+from packfile import write_pack, read_pack
 
+MOTOR_GAIN = 1 / 15
+FORMAT_VERSION = 1
+
+
+def identity(x):
+    return x
 
 def relu(x):
-    return max(0, x)
+    return np.maximum(0, x)
 
 def sigmoid(x):
-    return 1 / (1 + 2.71828 ** -x)
+    return 1 / (1 + np.exp(-x))
 
 def tanh(x):
-    return (2 / (1 + 2.71828 ** (-2 * x))) - 1
+    return np.tanh(x)
 
 def binary(x):
-    return 1 if x > 0 else 0
+    return np.where(x > 0, 1, 0)
+
+ACTIVATION_FUNCTIONS = {
+    "identity": identity,
+    "relu": relu,
+    "sigmoid": sigmoid,
+    "tanh": tanh,
+    "binary": binary,
+}
+
+def activation_name(function):
+    for name, known in ACTIVATION_FUNCTIONS.items():
+        if function is known:
+            return name
+    # functions restored from old pickles are copies, so match them by behaviour
+    probe = np.linspace(-3, 3, 13)
+    for name, known in ACTIVATION_FUNCTIONS.items():
+        if np.allclose([function(x) for x in probe], known(probe)):
+            return name
+    raise ValueError(f"Unknown activation function: {function}")
+
+def activation_function(name):
+    if name not in ACTIVATION_FUNCTIONS:
+        raise ValueError(f"Unknown activation function: {name}")
+    return ACTIVATION_FUNCTIONS[name]
+
+def check_format(meta, kind, filename):
+    if meta.get("format") != kind:
+        raise ValueError(f"{filename} does not contain {kind}")
+    if meta.get("version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported {kind} version {meta.get('version')} in {filename}")
 
 
 class NeuronParameters:
-    def __init__(self, num_inputs, activation_function=lambda x: x, bias=True):
+    def __init__(self, num_inputs, activation_function=identity, bias=True):
         self.num_inputs = num_inputs
         self.weights = [2 * random.random() - 1 for i in range(num_inputs)]
         self.biases = [2 * random.random() - 1 for i in range(num_inputs)] if bias else [0 for i in range(num_inputs)]
@@ -27,13 +64,30 @@ class NeuronParameters:
         return str(self.weights) + "\n" + str(self.biases)
 
     def save(self, filename):
-        with open(filename, "wb") as f:
-            dill.dump(self, f)
-        
+        arrays = {"weights": np.array(self.weights, dtype=np.float64), "biases": np.array(self.biases, dtype=np.float64)}
+        meta = {"format": "neuron_parameters", "version": FORMAT_VERSION,
+                "activation": activation_name(self.activation_function)}
+        write_pack(filename, arrays, meta)
+
     @staticmethod
     def load(filename):
+        arrays, meta = read_pack(filename)
+        check_format(meta, "neuron_parameters", filename)
+        parameters = NeuronParameters(len(arrays["weights"]), activation_function(meta["activation"]))
+        parameters.weights = arrays["weights"].tolist()
+        parameters.biases = arrays["biases"].tolist()
+        return parameters
+
+    @staticmethod
+    def load_legacy(filename):
+        # old dill pickles run arbitrary code on load, only use this on files you trust
+        import dill
         with open(filename, "rb") as f:
-            return dill.load(f)
+            old = dill.load(f)
+        parameters = NeuronParameters(old.num_inputs, ACTIVATION_FUNCTIONS[activation_name(old.activation_function)])
+        parameters.weights = list(old.weights)
+        parameters.biases = list(old.biases)
+        return parameters
 
 class Neuron:
     def __init__(self, parameters, inputs=None):
@@ -67,25 +121,148 @@ class MotorNeuron(Neuron):
     def __init__(self, muscle, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.muscle = muscle
-    
+
     def update_activation(self):
         self.activation = self.temp_activation
         if self.parameters.activation_function(self.activation) > 1:
             print("Muscle activating")
 
-class Ensemble:
-    def __init__(self, name, num_neurons, muscle):
-        self.neurons = [Neuron(NeuronParameters(num_neurons, sigmoid)) for i in range(num_neurons - 1)]
-        self.motor = MotorNeuron(muscle, NeuronParameters(num_neurons - 1, sigmoid))
 
-        self.num_neurons = num_neurons
+class Ensemble:
+    # num_neurons - 1 interneurons wired all-to-all, plus one motor neuron reading the interneurons
+    def __init__(self, name, num_neurons, muscle=None, activation_function=sigmoid):
         self.name = name
+        self.num_neurons = num_neurons
+        self.muscle = muscle
+        self.activation_function = activation_function
+
+        self.parameters = [NeuronParameters(num_neurons, activation_function) for i in range(num_neurons - 1)]
+        self.parameters.append(NeuronParameters(num_neurons - 1, activation_function))
+
+        self.weights = np.zeros((num_neurons, num_neurons))
+        self.bias = np.zeros(num_neurons)
+        for i, parameters in enumerate(self.parameters):
+            self.weights[i, :parameters.num_inputs] = parameters.weights
+            # each input contributes its own bias term
+            self.bias[i] = sum(parameters.biases)
+
+        self.activation = np.zeros(num_neurons)
 
-        for i in range(self.num_neurons - 1):
-            self.neurons[i].inputs = [self.neurons
+    def __repr__(self):
+        return f"Ensemble {self.name}: {self.activation}"
+
+    @property
+    def motor_activation(self):
+        return self.activation[-1]
+
+    def step(self):
+        self.activation[:] = self.activation_function(self.weights @ self.activation + self.bias)
+        return self.activation
+
+    def save(self, filename):
+        arrays = {"weights": self.weights, "bias": self.bias, "activation": self.activation}
+        meta = {"format": "ensemble", "version": FORMAT_VERSION, "name": self.name,
+                "activation": activation_name(self.activation_function)}
+        write_pack(filename, arrays, meta)
+
+    @staticmethod
+    def load(filename, muscle=None):
+        arrays, meta = read_pack(filename)
+        check_format(meta, "ensemble", filename)
+        ensemble = Ensemble.__new__(Ensemble)
+        ensemble.name = meta["name"]
+        ensemble.num_neurons = len(arrays["bias"])
+        ensemble.muscle = muscle
+        ensemble.activation_function = activation_function(meta["activation"])
+        ensemble.parameters = None
+        ensemble.weights = np.array(arrays["weights"])
+        ensemble.bias = np.array(arrays["bias"])
+        ensemble.activation = np.array(arrays["activation"])
+        return ensemble
+
+
+class EnsembleGroup:
+    # steps many ensembles as one batched matrix-vector product, padding smaller ones with silent neurons
+    def __init__(self, ensembles):
+        self.ensembles = list(ensembles)
+        functions = {e.activation_function for e in self.ensembles}
+        if len(functions) > 1:
+            raise ValueError("All ensembles in a group must share an activation function")
+        self.activation_function = functions.pop()
+
+        size = max(e.num_neurons for e in self.ensembles)
+        self.weights = np.zeros((len(self.ensembles), size, size))
+        self.bias = np.zeros((len(self.ensembles), size))
+        self.activation = np.zeros((len(self.ensembles), size))
+        self.mask = np.zeros((len(self.ensembles), size), dtype=bool)
+        self.motor = np.array([e.num_neurons - 1 for e in self.ensembles], dtype=np.intp)
 
+        for k, e in enumerate(self.ensembles):
+            n = e.num_neurons
+            self.weights[k, :n, :n] = e.weights
+            self.bias[k, :n] = e.bias
+            self.activation[k, :n] = e.activation
+            self.mask[k, :n] = True
+            e.weights = self.weights[k, :n, :n]
+            e.bias = self.bias[k, :n]
+            e.activation = self.activation[k, :n]
 
+        self._bind_muscles()
+
+    def _bind_muscles(self):
+        banks = {}
+        self.loose = []
+        for k, e in enumerate(self.ensembles):
+            if e.muscle is None:
+                continue
+            if e.muscle.bank is None:
+                self.loose.append(k)
+                continue
+            if id(e.muscle.bank) not in banks:
+                banks[id(e.muscle.bank)] = (e.muscle.bank, [], [])
+            bank, ensembles, muscles = banks[id(e.muscle.bank)]
+            ensembles.append(k)
+            muscles.append(e.muscle.index)
+
+        self.banks = [(bank, np.array(ensembles, dtype=np.intp), np.array(muscles, dtype=np.intp))
+                      for bank, ensembles, muscles in banks.values()]
+
+    @property
+    def motor_activation(self):
+        return self.activation[np.arange(len(self.ensembles)), self.motor]
+
+    def step(self, steps_size=None):
+        total = np.einsum("eij,ej->ei", self.weights, self.activation) + self.bias
+        self.activation[:] = np.where(self.mask, self.activation_function(total), 0)
+        if steps_size is not None:
+            self.drive_muscles(steps_size)
+        return self.activation
+
+    def snapshot(self):
+        return self.activation.copy()
+
+    def restore(self, activation):
+        # in place, since each ensemble's activation is a view into the group's
+        self.activation[:] = activation
+
+    def drive_muscles(self, steps_size):
+        motor = self.motor_activation * MOTOR_GAIN
+        for bank, ensembles, muscles in self.banks:
+            bank.drive(muscles, motor[ensembles], steps_size)
+        for k in self.loose:
+            muscle = self.ensembles[k].muscle
+            muscle.excitation = motor[k]
+            muscle.excitation_duration = steps_size
 
 
 if __name__ == "__main__":
-    e = Ensemble()
\ No newline at end of file
+    import sys
+
+    if len(sys.argv) == 4 and sys.argv[1] == "convert":
+        NeuronParameters.load_legacy(sys.argv[2]).save(sys.argv[3])
+        sys.exit()
+
+    group = EnsembleGroup([Ensemble(f"e{i}", 8) for i in range(4)])
+    for i in range(10):
+        group.step()
+    print(group.motor_activation)
@@ -0,0 +1,271 @@
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import simulation
+from hydra import HydraConfig, HYDRA_HEIGHT
+from rollout import summarize, model_key, DEFAULT_BRAIN
+from rollout_cache import digest, file_digest, open_cache
+
+EXPLODED_PENALTY = 1e4
+WARMUP = 1
+
+
+class CMAES:
+    # (mu/mu_w, lambda)-CMA-ES minimizing a black box cost, after Hansen's tutorial
+
+    def __init__(self, mean, sigma, popsize=None, seed=0):
+        self.mean = np.array(mean, dtype=np.float64)
+        self.sigma = sigma
+        self.n = n = len(self.mean)
+        self.popsize = popsize or 4 + int(3 * math.log(n))
+        self.mu = self.popsize // 2
+        self.rng = np.random.default_rng(seed)
+
+        weights = math.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / weights.sum()
+        self.mueff = 1 / (self.weights ** 2).sum()
+
+        self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+        self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2) ** 2 + self.mueff))
+        self.damps = 1 + 2 * max(0, math.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+        self.chi_n = math.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.C = np.eye(n)
+        self.B = np.eye(n)
+        self.D = np.ones(n)
+        self.generation = 0
+        self.evaluations = 0
+        self._eigen_at = 0
+        self.best = None
+        self.best_cost = float("inf")
+
+    def ask(self):
+        z = self.rng.standard_normal((self.popsize, self.n))
+        return self.mean + self.sigma * (z * self.D) @ self.B.T
+
+    def tell(self, solutions, costs):
+        solutions = np.asarray(solutions)
+        costs = np.asarray(costs, dtype=np.float64)
+        order = np.argsort(costs)
+        self.evaluations += len(costs)
+        self.generation += 1
+        if costs[order[0]] < self.best_cost:
+            self.best_cost = float(costs[order[0]])
+            self.best = solutions[order[0]].copy()
+
+        y = (solutions[order[:self.mu]] - self.mean) / self.sigma
+        yw = self.weights @ y
+        self.mean = self.mean + self.sigma * yw
+
+        inv_sqrt_c = (self.B / self.D) @ self.B.T
+        self.ps = (1 - self.cs) * self.ps + math.sqrt(self.cs * (2 - self.cs) * self.mueff) * inv_sqrt_c @ yw
+        ps_norm = np.linalg.norm(self.ps)
+        hsig = ps_norm / math.sqrt(1 - (1 - self.cs) ** (2 * self.generation)) / self.chi_n < 1.4 + 2 / (self.n + 1)
+        self.pc = (1 - self.cc) * self.pc + hsig * math.sqrt(self.cc * (2 - self.cc) * self.mueff) * yw
+
+        rank_one = np.outer(self.pc, self.pc) + (1 - hsig) * self.cc * (2 - self.cc) * self.C
+        rank_mu = (y.T * self.weights) @ y
+        self.C = (1 - self.c1 - self.cmu) * self.C + self.c1 * rank_one + self.cmu * rank_mu
+        self.sigma *= math.exp((self.cs / self.damps) * (ps_norm / self.chi_n - 1))
+
+        # the eigendecomposition is O(n^3), so only refresh it as often as C changes appreciably
+        if self.evaluations - self._eigen_at > self.popsize / (self.c1 + self.cmu) / self.n / 10:
+            self._eigen_at = self.evaluations
+            self.C = np.triu(self.C) + np.triu(self.C, 1).T
+            d2, self.B = np.linalg.eigh(self.C)
+            self.D = np.sqrt(np.maximum(d2, 1e-20))
+
+
+def head_cost(result, target):
+    return math.hypot(result["head"][0] - target[0], result["head"][1] - target[1])
+
+def length_cost(result, target):
+    return abs(result["length"] - target[0])
+
+OBJECTIVES = {"head": head_cost, "length": length_cost}
+
+
+_worker = {}
+
+
+def fresh_simulation(settings):
+    sim = simulation.Simulation(HydraConfig(settings["height"]))
+    sim.createHydra()
+    return sim
+
+
+def _init_worker(settings):
+    # settle once per process; every evaluation branches from the snapshot
+    sim = fresh_simulation(settings)
+    sim.run(settings["warmup"], settings["dt"], record=False)
+    _worker["snapshot"] = sim.snapshot()
+    _worker["settings"] = settings
+    if settings["kind"] == "weights":
+        from learning.inference import NumpyMotorControl
+        _worker["template"] = NumpyMotorControl.load(settings["brain_path"])
+
+
+def evaluate(params):
+    settings = _worker["settings"]
+    # a new space each time: pymunk's cached contact and joint impulses are not in the snapshot, so
+    # reusing one space would make a cost depend on the evaluations the worker ran before it
+    sim = fresh_simulation(settings)
+    sim.restore(_worker["snapshot"])
+    if settings["kind"] == "muscle":
+        sim.hydra.play_excitation(np.clip(params, -1, 1).reshape(sim.config.muscle_shape))
+    elif settings["kind"] == "weights":
+        from learning.inference import MotorInference
+        from controller import BrainController
+        brain = MotorInference(_worker["template"].from_vector(params), cache_size=0)
+        sim.controller = BrainController(sim.hydra, brain, threaded=False)
+    else:
+        raise ValueError(f"Unknown search space: {settings['kind']}")
+
+    with np.errstate(all="ignore"):
+        sim.run(settings["duration"], settings["dt"], record=False)
+
+    return score(summarize(sim.hydra), settings["objective"], settings["target"])
+
+
+def score(result, objective, target):
+    cost = OBJECTIVES[objective](result, target)
+    if result.get("status") == "EXPLODING" or not math.isfinite(cost):
+        cost = EXPLODED_PENALTY + (cost if math.isfinite(cost) else EXPLODED_PENALTY)
+    return cost
+
+
+def initial_mean(settings):
+    if settings["kind"] == "weights":
+        from learning.inference import NumpyMotorControl
+        return NumpyMotorControl.load(settings["brain_path"]).to_vector().astype(np.float64)
+    return np.zeros(int(np.prod(HydraConfig(settings["height"]).muscle_shape)))
+
+
+def evaluation_key(settings, params):
+    key = {**model_key(HydraConfig(settings["height"])), "settings": settings,
+           "params": np.asarray(params, dtype=np.float64)}
+    if settings["kind"] == "weights":
+        key["brain"] = file_digest(settings["brain_path"])
+    return digest(key)
+
+
+def optimize(kind="muscle", objective="head", target=(0, 300), generations=50, popsize=None, sigma=0.3,
+             duration=5, dt=1 / 60, warmup=WARMUP, processes=None, seed=0, brain_path=DEFAULT_BRAIN,
+             height=HYDRA_HEIGHT, log_every=1, cache=None):
+    settings = dict(kind=kind, objective=objective, target=tuple(target), duration=duration, dt=dt,
+                    warmup=warmup, brain_path=brain_path, height=height)
+    es = CMAES(initial_mean(settings), sigma, popsize, seed)
+    history = []
+
+    pool = None
+    if processes == 1:
+        _init_worker(settings)
+        run = lambda population: [evaluate(p) for p in population]
+    else:
+        processes = processes or os.cpu_count()
+        pool = ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(settings,))
+        chunksize = max(1, es.popsize // (processes * 2))
+        run = lambda population: list(pool.map(evaluate, population, chunksize=chunksize))
+
+    cache = open_cache(cache)
+    if cache is not None:
+        simulate = run
+
+        def run(population):
+            # only candidates never evaluated under these settings reach the workers
+            keys = [evaluation_key(settings, params) for params in population]
+            costs = [None] * len(population)
+            for i, key in enumerate(keys):
+                hit = cache.get(key)
+                if hit is not None:
+                    costs[i] = hit["cost"]
+            missing = [i for i, cost in enumerate(costs) if cost is None]
+            if missing:
+                for i, cost in zip(missing, simulate(population[missing])):
+                    costs[i] = float(cost)
+                    cache.put(keys[i], {"cost": costs[i]})
+            return costs
+
+    start = time.perf_counter()
+    try:
+        for generation in range(generations):
+            gen_start = time.perf_counter()
+            population = es.ask()
+            costs = run(population)
+            es.tell(population, costs)
+            elapsed = time.perf_counter() - gen_start
+            history.append({"generation": generation, "best": float(np.min(costs)), "mean": float(np.mean(costs)),
+                            "sigma": es.sigma, "evals_per_second": len(costs) / elapsed})
+            if log_every and generation % log_every == 0:
+                h = history[-1]
+                print(f"Generation {generation} best: {h['best']:.3f} mean: {h['mean']:.3f} "
+                      f"sigma: {h['sigma']:.4f} ({h['evals_per_second']:.1f} evals/s)")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    wall = time.perf_counter() - start
+
+    stats = {
+        "evaluations": es.evaluations,
+        "processes": processes,
+        "wall_seconds": wall,
+        "evals_per_second": es.evaluations / wall if wall > 0 else float("inf"),
+        "history": history,
+    }
+    if cache is not None:
+        stats["cache"] = cache.stats()
+    return es.best, es.best_cost, stats
+
+
+def save_result(params, kind, path, brain_path=DEFAULT_BRAIN, height=HYDRA_HEIGHT):
+    if kind == "weights":
+        from learning.inference import NumpyMotorControl
+        NumpyMotorControl.load(brain_path).from_vector(params).save(path)
+    else:
+        from activation_map import ActivationMap
+        amap = ActivationMap(HydraConfig(height).muscle_shape, (0, 0), 0)
+        amap.map[:] = np.clip(params, -1, 1).reshape(amap.map.shape)
+        amap.save_map(path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Search muscle maps or brain weights with CMA-ES")
+    parser.add_argument("--kind", choices=["muscle", "weights"], default="muscle",
+                        help="search a muscle activation map or the MotorControl weights driving closed-loop control")
+    parser.add_argument("--objective", choices=sorted(OBJECTIVES), default="head")
+    parser.add_argument("--target", type=float, nargs="+", default=[0, 300],
+                        help="head position x y, or the body length")
+    parser.add_argument("--generations", type=int, default=50)
+    parser.add_argument("--popsize", type=int, default=None)
+    parser.add_argument("--sigma", type=float, default=0.3)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--dt", type=float, default=1 / 60)
+    parser.add_argument("--warmup", type=float, default=WARMUP)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--brain", default=DEFAULT_BRAIN, help="starting weights for --kind weights")
+    parser.add_argument("--height", type=int, default=HYDRA_HEIGHT)
+    parser.add_argument("--out", default=None, help=".out map or .pack brain to save the best solution to")
+    parser.add_argument("--cache", default=None, help="directory of cached evaluations to reuse across runs")
+    args = parser.parse_args()
+
+    best, cost, stats = optimize(args.kind, args.objective, args.target, args.generations, args.popsize,
+                                 args.sigma, args.duration, args.dt, args.warmup, args.processes, args.seed,
+                                 args.brain, args.height, cache=args.cache)
+    print(f"Best cost {cost:.3f} after {stats['evaluations']} evaluations "
+          f"({stats['evals_per_second']:.1f} evals/s on {stats['processes']} processes)")
+    if "cache" in stats:
+        print(f"Cache: {stats['cache']['hits']} hits, {stats['cache']['misses']} misses")
+    if args.out is not None:
+        save_result(best, args.kind, args.out, args.brain, args.height)
+        print(f"Saved to {args.out}")
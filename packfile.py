@@ -0,0 +1,68 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"HYDRAPK\0"
+VERSION = 1
+ALIGN = 64
+PREAMBLE = struct.Struct("<8sII")
+
+
+def _align(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def write_pack(path, arrays, meta=None):
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({"meta": meta or {}, "arrays": entries}).encode("utf-8")
+    data_start = _align(PREAMBLE.size + len(header))
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + entries[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp, path)
+
+
+def is_pack(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_pack(path, mmap=True):
+    with open(path, "rb") as f:
+        magic, version, header_len = PREAMBLE.unpack(f.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a pack file")
+        if version != VERSION:
+            raise ValueError(f"Unsupported pack version {version} in {path}")
+        header = json.loads(f.read(header_len).decode("utf-8"))
+        data_start = _align(PREAMBLE.size + header_len)
+
+        arrays = {}
+        for name, entry in header["arrays"].items():
+            dtype = np.dtype(entry["dtype"])
+            shape = tuple(entry["shape"])
+            offset = data_start + entry["offset"]
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            elif mmap:
+                arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+            else:
+                f.seek(offset)
+                count = int(np.prod(shape))
+                arrays[name] = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+    return arrays, header["meta"]
@@ -0,0 +1,54 @@
+from time import perf_counter_ns
+
+import numpy as np
+
+WINDOW = 600
+PERCENTILES = (50, 90, 99)
+
+
+class Profiler:
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+
+    def start(self):
+        return perf_counter_ns()
+
+    def lap(self, name, start):
+        now = perf_counter_ns()
+        self.record(name, now - start)
+        return now
+
+    def record(self, name, ns):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = np.zeros(self.window, dtype=np.int64)
+            self.counts[name] = 0
+        samples[self.counts[name] % self.window] = ns
+        self.counts[name] += 1
+
+    def window_samples(self, name):
+        return self.samples[name][:min(self.counts[name], self.window)]
+
+    def percentiles(self, name, q=PERCENTILES):
+        samples = self.window_samples(name)
+        if len(samples) == 0:
+            return {p: 0.0 for p in q}
+        return dict(zip(q, np.percentile(samples, q).tolist()))
+
+    def summary(self, q=PERCENTILES):
+        return {name: {"count": self.counts[name],
+                       "mean_ns": float(self.window_samples(name).mean()),
+                       "percentiles_ns": self.percentiles(name, q)}
+                for name in self.samples}
+
+    def reset(self):
+        self.samples.clear()
+        self.counts.clear()
+
+    def draw(self, display, color=(0, 0, 255)):
+        for name in self.samples:
+            p = self.percentiles(name)
+            display.draw_log(f"{name}: " + " ".join(f"p{q} {v / 1e6:.2f}ms" for q, v in p.items()), color)
@@ -0,0 +1,130 @@
+import json
+import os
+
+import numpy as np
+
+FORMAT_VERSION = 2
+# version 1 recordings hold one hydra and have no hydra axis
+READABLE_VERSIONS = (1, 2)
+CHUNK_FRAMES = 4096
+HEADER_FILE = "header.json"
+
+
+def frame_dtype(n_cells, n_muscles, n_hydras=1):
+    return np.dtype([
+        ("time", np.float64),
+        ("pressure", np.float32, (n_hydras,)),
+        ("positions", np.float32, (n_hydras, n_cells, 2)),
+        ("velocities", np.float32, (n_hydras, n_cells, 2)),
+        ("activation", np.float32, (n_hydras, n_muscles)),
+    ])
+
+
+def segment_path(path, index):
+    return os.path.join(path, f"seg-{index:05d}.npy")
+
+
+class Recorder:
+
+    def __init__(self, path, hydras, dt, chunk_frames=CHUNK_FRAMES):
+        self.hydras = list(hydras)
+        hydra = self.hydras[0]
+        if any(h.config.height != hydra.config.height for h in self.hydras):
+            raise ValueError("every recorded hydra needs the same height")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.dtype = frame_dtype(hydra.state.n_cells, hydra.muscle_bank.n_muscles, len(self.hydras))
+
+        self.header = {
+            "version": FORMAT_VERSION,
+            "height": hydra.height,
+            "hydras": len(self.hydras),
+            "dt": dt,
+            "n_cells": hydra.state.n_cells,
+            "n_muscles": hydra.muscle_bank.n_muscles,
+            "n_endoderm": len(hydra.endoderm_muscles),
+            "muscle_a": hydra.state.muscle_a.tolist(),
+            "muscle_b": hydra.state.muscle_b.tolist(),
+            "chunk_frames": chunk_frames,
+            "frames": 0,
+        }
+        self.frames = 0
+        self.segment = None
+
+    def _new_segment(self):
+        if self.segment is not None:
+            self.segment.flush()
+        index = self.frames // self.chunk_frames
+        self.segment = np.lib.format.open_memmap(segment_path(self.path, index), mode="w+",
+                                                 dtype=self.dtype, shape=(self.chunk_frames,))
+        self.write_header()
+
+    def record(self, sim):
+        offset = self.frames % self.chunk_frames
+        if offset == 0:
+            self._new_segment()
+
+        frame = self.segment[offset]
+        frame["time"] = sim.time
+        for i, hydra in enumerate(self.hydras):
+            frame["pressure"][i] = hydra.pressure
+            frame["positions"][i] = hydra.state.gather()
+            frame["velocities"][i] = hydra.state.gather_velocities()
+            frame["activation"][i] = hydra.muscle_bank.activation
+        self.frames += 1
+
+    def write_header(self):
+        self.header["frames"] = self.frames
+        tmp = os.path.join(self.path, HEADER_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.header, f)
+        os.replace(tmp, os.path.join(self.path, HEADER_FILE))
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.flush()
+            self.segment = None
+        self.write_header()
+
+
+class Recording:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, HEADER_FILE)) as f:
+            self.header = json.load(f)
+        if self.header["version"] not in READABLE_VERSIONS:
+            raise ValueError(f"Unsupported recording version: {self.header['version']}")
+
+        self.frames = self.header["frames"]
+        self.dt = self.header["dt"]
+        self.chunk_frames = self.header["chunk_frames"]
+        self.muscle_a = np.array(self.header["muscle_a"], dtype=np.intp)
+        self.muscle_b = np.array(self.header["muscle_b"], dtype=np.intp)
+        self.n_endoderm = self.header["n_endoderm"]
+        self.n_hydras = self.header.get("hydras", 1)
+
+        n_segments = -(-self.frames // self.chunk_frames)
+        self.segments = [np.load(segment_path(path, i), mmap_mode="r") for i in range(n_segments)]
+
+    def __len__(self):
+        return self.frames
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.frames
+        if not 0 <= index < self.frames:
+            raise IndexError(index)
+        return self.segments[index // self.chunk_frames][index % self.chunk_frames]
+
+    def field(self, name, start=0, stop=None):
+        stop = self.frames if stop is None else min(stop, self.frames)
+        parts = []
+        for i in range(start // self.chunk_frames, -(-stop // self.chunk_frames)):
+            lo = max(start - i * self.chunk_frames, 0)
+            hi = min(stop - i * self.chunk_frames, self.chunk_frames)
+            parts.append(self.segments[i][name][lo:hi])
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts) if parts else np.zeros((0,) + self.segments[0].dtype[name].shape)
@@ -0,0 +1,198 @@
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import simulation
+from hydra import HydraConfig
+from hydra_state import PRESSURE_THRESHOLD
+from rollout_cache import CACHE_VERSION, digest, file_digest, open_cache
+
+DEFAULT_BRAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "learning", "model.pack")
+
+_worker_brain_path = None
+_brains = {}
+
+
+def _init_worker(brain_path):
+    global _worker_brain_path
+    _worker_brain_path = brain_path
+
+
+def load_brain(path):
+    if path not in _brains:
+        from learning.inference import MotorInference
+        _brains[path] = MotorInference.load(path)
+    return _brains[path]
+
+
+def summarize(hydra):
+    head = (hydra.roof.body1.position + hydra.roof.body2.position) / 2
+    return {
+        "length": hydra.calc_length(),
+        "area": float(hydra.calc_area()),
+        "pressure": float(hydra.pressure),
+        "head": (head.x, head.y),
+        "head_displacement": head.get_distance(hydra.original_head_pos),
+        "status": hydra.status,
+    }
+
+
+def model_key(config):
+    # the hydra and world constants every cached result depends on
+    return {
+        "version": CACHE_VERSION,
+        "config": vars(config),
+        "model": [simulation.SPACE_DAMPING, simulation.FLOOR_RADIUS, simulation.PLATFORM_SIZE, PRESSURE_THRESHOLD],
+    }
+
+
+def rollout_key(map, kind="muscle", duration=15, dt=1 / 60, substeps=1, brain_path=None, record=True, config=None):
+    # everything a rollout depends on; the seed is left out because the physics is deterministic
+    parts = {
+        **model_key(HydraConfig() if config is None else config),
+        "map": np.asarray(map, dtype=np.float64),
+        "kind": kind,
+        "duration": float(duration),
+        "dt": float(dt),
+        "substeps": substeps,
+        "record": record,
+    }
+    if kind == "nerve":
+        parts["brain"] = file_digest(brain_path or _worker_brain_path or DEFAULT_BRAIN)
+    return digest(parts)
+
+
+def rollout(map, kind="muscle", duration=15, dt=1 / 60, substeps=1, seed=0, brain_path=None, record=True,
+            cache=None, config=None):
+    config = HydraConfig() if config is None else config
+    cache = open_cache(cache)
+    if cache is not None:
+        key = rollout_key(map, kind, duration, dt, substeps, brain_path, record, config)
+        result = cache.get(key)
+        if result is not None:
+            result["seed"] = seed
+            return result
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+    sim = simulation.Simulation(config)
+    sim.createHydra()
+    map = np.asarray(map, dtype=np.float64)
+    if kind == "muscle":
+        sim.hydra.play_excitation(map)
+    elif kind == "nerve":
+        sim.hydra.brain = load_brain(brain_path or _worker_brain_path or DEFAULT_BRAIN)
+        sim.hydra.play_input(map)
+    else:
+        raise ValueError(f"Unknown map kind: {kind}")
+
+    recording = sim.run(duration, dt, substeps, record=record)
+    result = summarize(sim.hydra)
+    result["seed"] = seed
+    if recording is not None:
+        result["trajectory"] = recording
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+
+def _rollout_job(job):
+    return rollout(**job)
+
+
+def batch_rollout(maps, kind="muscle", duration=15, dt=1 / 60, substeps=1, seed=0,
+                  processes=None, brain_path=DEFAULT_BRAIN, record=True, cache=None, config=None):
+    config = HydraConfig() if config is None else config
+    jobs = [dict(map=map, kind=kind, duration=duration, dt=dt, substeps=substeps,
+                 seed=seed + i, brain_path=brain_path, record=record, config=config)
+            for i, map in enumerate(maps)]
+
+    start = time.perf_counter()
+    # look everything up here and only send the misses to the workers
+    cache = open_cache(cache)
+    results = [None] * len(jobs)
+    keys = [None] * len(jobs)
+    if cache is not None:
+        for i, job in enumerate(jobs):
+            keys[i] = rollout_key(job["map"], kind, duration, dt, substeps, brain_path, record, config)
+            results[i] = cache.get(keys[i])
+            if results[i] is not None:
+                results[i]["seed"] = job["seed"]
+    pending = [i for i, result in enumerate(results) if result is None]
+    duplicates = {}
+    if cache is not None:
+        # identical jobs in one batch are simulated once
+        first = {}
+        for i in pending:
+            first.setdefault(keys[i], i)
+            if first[keys[i]] != i:
+                duplicates[i] = first[keys[i]]
+        pending = list(first.values())
+
+    if processes == 1:
+        _init_worker(brain_path)
+        computed = [_rollout_job(jobs[i]) for i in pending]
+    elif pending:
+        processes = processes or os.cpu_count()
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(brain_path,)) as pool:
+            chunksize = max(1, len(pending) // (processes * 4))
+            computed = list(pool.map(_rollout_job, [jobs[i] for i in pending], chunksize=chunksize))
+    else:
+        computed = []
+    for i, result in zip(pending, computed):
+        results[i] = result
+        if cache is not None:
+            cache.put(keys[i], result)
+    for i, source in duplicates.items():
+        results[i] = dict(results[source], seed=jobs[i]["seed"])
+    wall = time.perf_counter() - start
+
+    sim_seconds = duration * len(jobs)
+    stats = {
+        "rollouts": len(jobs),
+        "processes": processes,
+        "sim_seconds": sim_seconds,
+        "wall_seconds": wall,
+        "throughput": sim_seconds / wall if wall > 0 else float("inf"),
+    }
+    if cache is not None:
+        stats["cache"] = cache.stats()
+    return results, stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Roll out activation maps in parallel")
+    parser.add_argument("maps", nargs="+", help=".out muscle maps or .in nerve maps")
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--dt", type=float, default=1 / 60)
+    parser.add_argument("--substeps", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--cache", default=None, help="directory of cached rollout results to reuse")
+    args = parser.parse_args()
+
+    from activation_map import ActivationMap
+    from hydra import HydraConfig
+
+    kind = "nerve" if args.maps[0].endswith(".in") else "muscle"
+    maps = []
+    for path in args.maps:
+        config = HydraConfig()
+        amap = ActivationMap(config.nerve_shape if kind == "nerve" else config.muscle_shape, (0, 0), 0)
+        amap.load_map(path)
+        maps.append(amap.map)
+
+    results, stats = batch_rollout(maps, kind, args.duration, args.dt, args.substeps, args.seed,
+                                   args.processes, record=False, cache=args.cache)
+    for path, result in zip(args.maps, results):
+        print(f"{path}: length {result['length']:.2f} head displacement {result['head_displacement']:.2f} "
+              f"status {result['status']}")
+    print(f"{stats['rollouts']} rollouts, {stats['throughput']:.1f} simulated s per wall s")
+    if "cache" in stats:
+        print(f"cache: {stats['cache']['hits']} hits, {stats['cache']['misses']} misses")
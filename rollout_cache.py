@@ -0,0 +1,192 @@
+import hashlib
+import io
+import json
+import os
+import zipfile
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CACHE_VERSION = 1
+MAX_BYTES = 1 << 30
+# rescan the directory for eviction after roughly this fraction of max_bytes has been written
+CHECK_FRACTION = 1 / 16
+
+_file_digests = {}
+
+
+def canonical(obj):
+    # JSON-able form in which arrays are replaced by a digest of their dtype, shape and bytes
+    if isinstance(obj, (np.ndarray, np.generic)):
+        array = np.ascontiguousarray(obj)
+        return {"ndarray": hashlib.sha256(array.tobytes()).hexdigest(),
+                "dtype": array.dtype.str, "shape": list(array.shape)}
+    if isinstance(obj, dict):
+        return {str(k): canonical(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [canonical(v) for v in obj]
+    if isinstance(obj, float):
+        return repr(obj)
+    return obj
+
+
+def digest(obj):
+    text = json.dumps(canonical(obj), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_digest(path):
+    stat = os.stat(path)
+    memo = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if memo not in _file_digests:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _file_digests[memo] = h.hexdigest()
+    return _file_digests[memo]
+
+
+def encode(result):
+    arrays = {}
+    summary = {}
+    for name, value in result.items():
+        if name == "trajectory":
+            for field, data in value.items():
+                arrays["trajectory." + field] = np.asarray(data)
+        else:
+            summary[name] = value
+    arrays["summary"] = np.frombuffer(json.dumps(summary).encode("utf-8"), dtype=np.uint8)
+    return arrays
+
+
+def decode(data):
+    result = json.loads(bytes(data["summary"]).decode("utf-8"))
+    if "head" in result:
+        result["head"] = tuple(result["head"])
+    trajectory = {name.split(".", 1)[1]: data[name] for name in data.files if name.startswith("trajectory.")}
+    if trajectory:
+        if "status" in trajectory:
+            trajectory["status"] = trajectory["status"].tolist()
+        result["trajectory"] = trajectory
+    return result
+
+
+class RolloutCache:
+    # rollout results on local disk under a digest of their inputs; atomic writes, LRU eviction past max_bytes
+    def __init__(self, root, max_bytes=MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._written = 0
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + ".npz")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                result = decode(data)
+            os.utime(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # missing, or evicted or replaced by another process while we read it
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **encode(result))
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(buffer.getbuffer())
+        os.replace(tmp, path)
+
+        self.writes += 1
+        self._written += buffer.tell()
+        if self._written >= self.max_bytes * CHECK_FRACTION:
+            self.evict()
+
+    def entries(self):
+        for sub in os.scandir(self.root):
+            if sub.is_dir():
+                for entry in os.scandir(sub.path):
+                    if entry.name.endswith(".npz"):
+                        yield entry
+
+    def size(self):
+        return sum(entry.stat().st_size for entry in self.entries())
+
+    def evict(self):
+        self._written = 0
+        with open(os.path.join(self.root, ".lock"), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for entry in self.entries():
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.evictions += 1
+
+    def clear(self):
+        for entry in list(self.entries()):
+            os.remove(entry.path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+
+def open_cache(cache):
+    if cache is None or isinstance(cache, RolloutCache):
+        return cache
+    return RolloutCache(cache)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or clear a rollout cache")
+    parser.add_argument("root")
+    parser.add_argument("--clear", action="store_true")
+    parser.add_argument("--max-bytes", type=int, default=None, help="evict down to this size")
+    args = parser.parse_args()
+
+    cache = RolloutCache(args.root)
+    if args.clear:
+        cache.clear()
+    if args.max_bytes is not None:
+        cache.max_bytes = args.max_bytes
+        cache.evict()
+    entries = list(cache.entries())
+    print(f"{len(entries)} entries, {sum(e.stat().st_size for e in entries) / 2 ** 20:.1f} MiB in {args.root}")
@@ -1,29 +1,85 @@
 import pymunk
-import pygame
+import numpy as np
 import hydra
+from hydra import EXPLODING_SPEED, HydraConfig
+from hydra_state import save_bodies, load_bodies, BODY_FIELDS
 from cell import Cell, CellFixed
 from muscle import Muscle, EndodermMuscle, EctodermMuscle
 from activation_map import ActivationMap
+from controller import BrainController, CONTROL_RATE
+from motor_program import ProgramPlayer
+from profiler import Profiler
 
 PLATFORM_SIZE = 300
+FLOOR_RADIUS = 2
+SPACE_DAMPING = 0.7
+# with sleep on, bodies slower than IDLE_SPEED for SLEEP_TIME seconds stop being simulated until
+# disturbed; freezing that last slow creep perturbs later motion, so rollouts leave it off
+IDLE_SPEED = 1
+SLEEP_TIME = 1
+HYDRA_SPACING = 100
+BACKENDS = ("pymunk", "mass_spring")
+
+MAX_SUBSTEPS = 32
+RELAX_AFTER = 60
+VELOCITY_JUMP = 100
+ENERGY_JUMP = 4
+ENERGY_FLOOR = 50 ** 2
+def unstable(before, after, hydra):
+    # a collapsed or inverted body shows up as a non-finite pressure
+    if not np.isfinite(after).all() or not np.isfinite(hydra.pressure):
+        return True
+
+    v0 = before[:, 2:4]
+    v1 = after[:, 2:4]
+    if (v1 ** 2).sum(axis=1).max() > EXPLODING_SPEED ** 2:
+        return True
+    if np.abs(v1 - v0).max() > VELOCITY_JUMP:
+        return True
+    energy0 = (v0 ** 2).sum()
+    energy1 = (v1 ** 2).sum()
+    return energy1 > ENERGY_FLOOR and energy1 > ENERGY_JUMP * energy0
+
+
 class Simulation:
 
-    def __init__(self):
+    def __init__(self, config=None, sleep=False, backend="pymunk"):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend: {backend}")
+        self.config = HydraConfig() if config is None else config
+        self.backend = backend
+        # with the mass_spring backend the hydras live outside the space, which then only moves free cells
+        self.mass_spring = None
         self.space = pymunk.Space()
         self.display = None
         self.TIMESCALE = 1
         self.time = 0
-        self.space.damping = 0.7
+        self.space.damping = SPACE_DAMPING
+        if sleep:
+            self.space.idle_speed_threshold = IDLE_SPEED
+            self.space.sleep_time_threshold = SLEEP_TIME
 
         self.cells = []
         self.muscles = []
+        self.free_cells = []
+        self.free_muscles = []
         self.hydra = None
+        self.hydras = []
+        self.initial_snapshot = None
+        self.recorder = None
+        self.controller = None
+        self.players = []
+        self.ensembles = None
+        self.profiler = None
+        self.adaptive = {"substeps": 1, "calm": 0, "steps": 0, "retries": 0, "total_substeps": 0, "max_substeps": 1}
+        self._adaptive_snapshot = None
+        self._adaptive_time = None
 
-        floor = pymunk.Segment(self.space.static_body, (-PLATFORM_SIZE, 0), (PLATFORM_SIZE, 0), 2)
+        floor = pymunk.Segment(self.space.static_body, (-PLATFORM_SIZE, 0), (PLATFORM_SIZE, 0), FLOOR_RADIUS)
         self.space.add(floor)
 
-        self.nerve_activation = ActivationMap((14, 2),(-PLATFORM_SIZE + PLATFORM_SIZE / 4, PLATFORM_SIZE / 2), 18)
-        self.muscle_activation = ActivationMap((14, 3), (PLATFORM_SIZE + -PLATFORM_SIZE / 4, PLATFORM_SIZE / 2), 18)
+        self.nerve_activation = ActivationMap(self.config.nerve_shape,(-PLATFORM_SIZE + PLATFORM_SIZE / 4, PLATFORM_SIZE / 2), 18)
+        self.muscle_activation = ActivationMap(self.config.muscle_shape, (PLATFORM_SIZE + -PLATFORM_SIZE / 4, PLATFORM_SIZE / 2), 18)
 
     def addDisplay(self, display):
         self.display = display
@@ -33,48 +89,275 @@ class Simulation:
             return self.display.screen_size
 
     def step(self, fps):
-        self.space.step(self.TIMESCALE /fps)
-        for muscle in self.muscles:
-            muscle.step(self.TIMESCALE /fps)
+        self.advance(self.TIMESCALE / fps)
         if self.hydra is not None:
-            self.hydra.step(self.TIMESCALE / fps)
+            t = self.profiler.start() if self.profiler else 0
             self.muscle_activation.map = self.hydra.get_excitation() * 20
-        
-        self.time += self.TIMESCALE / fps
+            if self.profiler:
+                self.profiler.lap("activation map", t)
+
+    def advance(self, dt, substeps=1):
+        self._integrate(dt, substeps)
+        if self.recorder is not None:
+            t = self.profiler.start() if self.profiler else 0
+            self.recorder.record(self)
+            if self.profiler:
+                self.profiler.lap("record", t)
+
+    def _integrate(self, dt, substeps):
+        prof = self.profiler
+        h = dt / substeps
+        for _ in range(substeps):
+            t = prof.start() if prof else 0
+            if self.players:
+                self.step_players(h)
+            if self.controller is not None:
+                self.controller.step(self.time)
+            if self.ensembles is not None:
+                self.ensembles.step(h)
+            if prof:
+                t = prof.lap("control", t)
+            self.space.step(h)
+            if self.backend == "mass_spring" and self.hydras:
+                if self.mass_spring is None:
+                    from mass_spring import MassSpringBackend
+                    self.mass_spring = MassSpringBackend(self.hydras, self.space.damping)
+                self.mass_spring.step(h)
+            if prof:
+                t = prof.lap("space", t)
+            for muscle in self.free_muscles:
+                muscle.step(h)
+            for hydra in self.hydras:
+                hydra.step(h)
+            if prof:
+                prof.lap("hydra", t)
+            self.time += h
+
+    def step_players(self, dt):
+        for player in self.players:
+            player.step(self.time, dt)
+        if any(player.finished for player in self.players):
+            self.players = [player for player in self.players if not player.finished]
+
+    def play_program(self, program, hydra=None, loop=None):
+        # starts now and streams into the muscles every substep until the program ends
+        player = ProgramPlayer(program, self.hydra if hydra is None else hydra, self.time, loop=loop)
+        self.players.append(player)
+        return player
+
+    def advance_adaptive(self, dt, max_substeps=MAX_SUBSTEPS):
+        # take the whole dt in as few substeps as possible, rolling back and subdividing when the hydra blows up
+        stats = self.adaptive
+        time = self.time
+        # the snapshot taken after the last accepted step is still current if nothing ran since
+        before = self._adaptive_snapshot if self._adaptive_time == time else self.snapshot()
+        before_bodies = [hydra.snapshot_bodies(blob) for hydra, blob in self._hydra_blobs(before)]
+        control = self._control_snapshot()
+        substeps = stats["substeps"]
+        while True:
+            self._integrate(dt, substeps)
+            after = self.snapshot()
+            if substeps >= max_substeps or not any(
+                    unstable(b, hydra.snapshot_bodies(blob), hydra)
+                    for b, (hydra, blob) in zip(before_bodies, self._hydra_blobs(after))):
+                break
+            self.restore(before)
+            self._restore_control(control)
+            substeps = min(substeps * 2, max_substeps)
+            stats["retries"] += 1
+
+        if substeps != stats["substeps"]:
+            stats["substeps"] = substeps
+            stats["calm"] = 0
+        else:
+            stats["calm"] += 1
+            if stats["calm"] >= RELAX_AFTER and substeps > 1:
+                stats["substeps"] = substeps // 2
+                stats["calm"] = 0
+        self._adaptive_snapshot = after
+        self._adaptive_time = self.time
+        stats["steps"] += 1
+        stats["total_substeps"] += substeps
+        stats["max_substeps"] = max(stats["max_substeps"], substeps)
+
+        if self.recorder is not None:
+            self.recorder.record(self)
+
+    def snapshot(self):
+        # time, free cells, free muscles, then one blob per hydra; restore() expects the same objects
+        bodies = [cell.body for cell in self.free_cells if cell.body.body_type == pymunk.Body.DYNAMIC]
+        parts = [[self.time], save_bodies(bodies).ravel()]
+        parts.extend([m.excitation, m.excitation_duration, m.activation] for m in self.free_muscles)
+        parts.extend(hydra.snapshot() for hydra in self.hydras)
+        return np.concatenate(parts)
+
+    def restore(self, blob):
+        bodies = [cell.body for cell in self.free_cells if cell.body.body_type == pymunk.Body.DYNAMIC]
+        n_bodies = len(bodies) * BODY_FIELDS
+        n_muscles = 3 * len(self.free_muscles)
+        sizes = [hydra.snapshot_size() for hydra in self.hydras]
+        expected = 1 + n_bodies + n_muscles + sum(sizes)
+        if len(blob) != expected:
+            raise ValueError(f"snapshot has {len(blob)} values, expected {expected}")
+
+        self.time = float(blob[0])
+        load_bodies(bodies, blob[1:1 + n_bodies].reshape(-1, BODY_FIELDS))
+        muscles = blob[1 + n_bodies:1 + n_bodies + n_muscles].reshape(-1, 3)
+        for muscle, (excitation, duration, activation) in zip(self.free_muscles, muscles.tolist()):
+            muscle.excitation = excitation
+            muscle.excitation_duration = duration
+            muscle.activation = activation
+        for hydra, part in self._hydra_blobs(blob):
+            hydra.restore(part)
+        self._adaptive_snapshot = None
+        self._adaptive_time = None
+
+    def _control_snapshot(self):
+        # what the controller, ensembles and players carry between substeps, so a rejected attempt leaves no trace
+        controller = self.controller.snapshot() if self.controller is not None else None
+        ensembles = self.ensembles.snapshot() if self.ensembles is not None else None
+        players = [(player, player.snapshot()) for player in self.players]
+        return controller, ensembles, players
+
+    def _restore_control(self, state):
+        controller, ensembles, players = state
+        self.players = [player for player, _ in players]
+        for player, player_state in players:
+            player.restore(player_state)
+        if controller is not None:
+            self.controller.restore(controller)
+        if ensembles is not None:
+            self.ensembles.restore(ensembles)
+
+    def _hydra_blobs(self, blob):
+        # each hydra's part of a snapshot, which always ends with them
+        start = len(blob) - sum(hydra.snapshot_size() for hydra in self.hydras)
+        for hydra in self.hydras:
+            size = hydra.snapshot_size()
+            yield hydra, blob[start:start + size]
+            start += size
+
+    def enable_profiling(self, enabled=True):
+        self.profiler = Profiler() if enabled else None
+        for hydra in self.hydras:
+            hydra.profiler = self.profiler
+
+    def run(self, duration, dt=1 / 60, substeps=1, record=True, adaptive=False):
+        n_steps = int(round(duration / dt))
+        recording = None
+        if record and self.hydra is not None:
+            hydras = self.hydras
+            if any(h.config.height != self.hydra.config.height for h in hydras):
+                raise ValueError("every recorded hydra needs the same height")
+            recording = {
+                "time": np.zeros(n_steps),
+                "positions": np.zeros((n_steps, len(hydras), self.hydra.state.n_cells, 2)),
+                "velocities": np.zeros((n_steps, len(hydras), self.hydra.state.n_cells, 2)),
+                "activation": np.zeros((n_steps, len(hydras), self.hydra.muscle_bank.n_muscles)),
+                "pressure": np.zeros((n_steps, len(hydras))),
+                "status": [],
+            }
+
+        for i in range(n_steps):
+            if adaptive and self.hydra is not None:
+                self.advance_adaptive(dt)
+            else:
+                self.advance(dt, substeps)
+            if recording is not None:
+                recording["time"][i] = self.time
+                for j, h in enumerate(hydras):
+                    recording["positions"][i, j] = h.state.gather()
+                    recording["velocities"][i, j] = h.state.gather_velocities()
+                    recording["activation"][i, j] = h.muscle_bank.activation
+                    recording["pressure"][i, j] = h.pressure
+                recording["status"].append([h.status for h in hydras])
+
+        if recording is not None and len(hydras) == 1:
+            # a single hydra keeps the flat shapes rollouts rely on
+            for name in ("positions", "velocities", "activation", "pressure"):
+                recording[name] = recording[name][:, 0]
+            recording["status"] = [status[0] for status in recording["status"]]
+        return recording
 
 
     def draw(self):
         if self.display is not None:
             self.display.draw_log(f"Time: {self.time:.2f}", (255, 0, 0))
-            self.hydra.draw(self.display)
+            for hydra in self.hydras:
+                hydra.draw(self.display)
             self.nerve_activation.draw(self.display)
             self.muscle_activation.draw(self.display)
 
     def addCell(self, x, y):
         cell = Cell(x, y, self.space)
         self.cells.append(cell)
+        self.free_cells.append(cell)
         return cell
 
     def addCellFixed(self, x, y):
         cell = CellFixed(x, y, self.space)
         self.cells.append(cell)
+        self.free_cells.append(cell)
         return cell
     
     def addEndodermMuscle(self, cell1, cell2):
         muscle = EndodermMuscle(cell1, cell2, self.space)
         self.muscles.append(muscle)
+        self.free_muscles.append(muscle)
         return muscle
     
     def addEctodermMuscle(self, cell1, cell2, side):
         muscle = EctodermMuscle(cell1, cell2, side, self.space)
         self.muscles.append(muscle)
+        self.free_muscles.append(muscle)
         return muscle
     
-    def createHydra(self):
-        self.hydra = hydra.Hydra(self.space)
-        self.cells.extend(self.hydra.cells)
-        self.muscles.extend(self.hydra.endoderm_muscles)
-        self.muscles.extend(self.hydra.ectoderm_muscles)
+    def createHydra(self, height=None, config=None):
+        # replace every hydra in the space with a single one
+        for old in list(self.hydras):
+            self.removeHydra(old)
+        if config is None:
+            config = self.config if height is None else self.config.replace(height=height)
+        if config.nerve_shape != self.config.nerve_shape:
+            self.nerve_activation.map = np.zeros(config.nerve_shape)
+            self.muscle_activation.map = np.zeros(config.muscle_shape)
+        self.config = config
+        self.addHydra(config)
+
+    def addHydra(self, config=None, offset=(0, 0)):
+        new = hydra.Hydra(self.space, config=self.config if config is None else config, offset=offset)
+        if self.backend == "mass_spring":
+            new.remove(self.space)
+            self.mass_spring = None
+        new.profiler = self.profiler
+        self.hydras.append(new)
+        if self.hydra is None:
+            self.hydra = new
+        self.cells.extend(new.cells)
+        self.muscles.extend(new.endoderm_muscles)
+        self.muscles.extend(new.ectoderm_muscles)
+        self.initial_snapshot = self.snapshot()
+        return new
+
+    def addHydras(self, count, config=None, spacing=HYDRA_SPACING):
+        # side by side, centered on the origin
+        first = -(count - 1) * spacing / 2
+        return [self.addHydra(config, (first + i * spacing, 0)) for i in range(count)]
+
+    def removeHydra(self, old):
+        if self.backend == "mass_spring":
+            self.mass_spring = None
+        else:
+            old.remove(self.space)
+        cells = set(map(id, old.cells))
+        muscles = set(map(id, old.endoderm_muscles + old.ectoderm_muscles))
+        self.cells = [cell for cell in self.cells if id(cell) not in cells]
+        self.muscles = [muscle for muscle in self.muscles if id(muscle) not in muscles]
+        self.hydras.remove(old)
+        self.players = [player for player in self.players if player.bank is not old.muscle_bank]
+        if self.hydra is old:
+            self.hydra = self.hydras[0] if self.hydras else None
+        self.initial_snapshot = None
         
     def mouse_click(self, pos, radius, amount):
         for muscle in self.muscles:
@@ -90,15 +373,21 @@ class Simulation:
 
     
     def handle_input(self, event):
+        import pygame
         if event.type == pygame.KEYDOWN:
             if event.key == pygame.K_c:
                 self.hydra.contract()
             if event.key == pygame.K_e:
                 self.hydra.elongate()
             if event.key == pygame.K_r:
-                self.createHydra()
+                if self.controller is not None:
+                    self.toggle_controller()
+                if self.initial_snapshot is None:
+                    self.createHydra()
+                else:
+                    self.restore(self.initial_snapshot)
                 self.nerve_activation.reset_map()
-                self.hydra.load_brain("./learning/model.pt")
+                self.hydra.load_brain("./learning/model.pack")
             if event.key == pygame.K_k:
                 self.nerve_activation.save_map("./learning/data/temp.in")
                 self.muscle_activation.save_map("./learning/data/temp.out")
@@ -109,5 +398,57 @@ class Simulation:
                 self.hydra.play_excitation(self.muscle_activation.map)
             if event.key == pygame.K_p:
                 self.muscle_activation.map = self.hydra.play_input(self.nerve_activation.map)
+            if event.key == pygame.K_b:
+                self.toggle_controller()
+
+    def toggle_controller(self, rate=CONTROL_RATE):
+        if self.controller is not None:
+            self.controller.close()
+            self.controller = None
+        elif self.hydra is not None and self.hydra.brain is not None:
+            self.controller = BrainController(self.hydra, rate=rate)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Run the hydra simulation headless")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--dt", type=float, default=1 / 60)
+    parser.add_argument("--substeps", type=int, default=1)
+    parser.add_argument("--adaptive", action="store_true", help="subdivide steps only when the hydra becomes unstable")
+    parser.add_argument("--out", default=None, help="save the recorded state to this .npz file")
+    parser.add_argument("--record", default=None, help="stream frames to this recording directory")
+    parser.add_argument("--height", type=int, default=hydra.HYDRA_HEIGHT)
+    parser.add_argument("--hydras", type=int, default=1, help="independent hydras sharing the space")
+    parser.add_argument("--sleep", action="store_true", help="stop simulating hydras that have come to rest")
+    parser.add_argument("--program", default=None, help="motor program to play on every hydra")
+    parser.add_argument("--backend", choices=BACKENDS, default="pymunk",
+                        help="physics for the hydras; mass_spring solves them all in one batched NumPy step")
+    args = parser.parse_args()
+
+    sim = Simulation(HydraConfig(args.height), sleep=args.sleep, backend=args.backend)
+    sim.addHydras(args.hydras)
+    if args.program is not None:
+        from motor_program import MotorProgram
+        program = MotorProgram.load(args.program)
+        for h in sim.hydras:
+            sim.play_program(program, h)
+    if args.record is not None:
+        from recorder import Recorder
+        sim.recorder = Recorder(args.record, sim.hydras, args.dt)
+    start = time.perf_counter()
+    recording = sim.run(args.duration, args.dt, args.substeps, record=args.out is not None, adaptive=args.adaptive)
+    elapsed = time.perf_counter() - start
+    print(f"Simulated {sim.time:.2f}s of {len(sim.hydras)} hydra(s) in {elapsed:.2f}s "
+          f"({sim.time / elapsed:.1f}x real time), status {sim.hydra.status}")
+    if args.adaptive:
+        stats = sim.adaptive
+        print(f"Adaptive: {stats['total_substeps'] / max(stats['steps'], 1):.2f} substeps per step on average, "
+              f"{stats['retries']} retries, at most {stats['max_substeps']} substeps")
 
-                
+    if args.out is not None:
+        np.savez(args.out, **recording)
+    if sim.recorder is not None:
+        sim.recorder.close()
@@ -1,8 +1,16 @@
+import time
 import pygame
+import numpy as np
 import simulation
+from cell import CELL_RADIUS, CELL_COLOR
+from muscle import ENDODERM_COLOR, ECTODERM_COLOR
 
 SCREEN_SIZE = 600
 FPS = 60
+MAX_FRAME_TIME = 0.25
+PHYSICS_BUDGET = 0.8
+MIN_WARP = 1 / 8
+MAX_WARP = 128
 
 class Viewer:
 
@@ -21,15 +29,52 @@ class Viewer:
         self.mouse_state = "UP"
         self.speed_up = False
 
+        self.warp = 1
+        self.accumulator = 0
+        self.sim_rate = 0
+
     def run(self):
+        last = time.perf_counter()
         while self.running:
-            if not self.speed_up:
-                self.clock.tick(self.FPS)
+            self.clock.tick(self.FPS)
+            now = time.perf_counter()
+            frame_time = min(now - last, MAX_FRAME_TIME)
+            last = now
 
+            prof = self.simulation.profiler
+            t = prof.start() if prof else 0
             self.handle_events()
             self.handle_mouse()
-            self.simulation.step(FPS)
+            if prof:
+                t = prof.lap("events", t)
+            sim_start = self.simulation.time
+            self.step_physics(frame_time, now)
+            if frame_time > 0:
+                self.sim_rate = (self.simulation.time - sim_start) / frame_time
+            if prof:
+                t = prof.lap("physics", t)
             self.draw()
+            if prof:
+                prof.lap("draw", t)
+
+    def step_physics(self, frame_time, frame_start):
+        # physics gets a fixed share of each display frame, rendering always gets the rest
+        deadline = frame_start + PHYSICS_BUDGET / self.FPS
+        dt = self.simulation.TIMESCALE / FPS
+        if self.speed_up:
+            self.accumulator = 0
+            while time.perf_counter() < deadline:
+                self.simulation.step(FPS)
+            return
+
+        self.accumulator += frame_time * self.warp
+        while self.accumulator >= dt:
+            self.simulation.step(FPS)
+            self.accumulator -= dt
+            if time.perf_counter() > deadline:
+                # cannot keep up with the requested warp, drop the backlog instead of spiralling
+                self.accumulator = min(self.accumulator, dt)
+                break
 
 
     def handle_events(self):
@@ -50,6 +95,12 @@ class Viewer:
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_s:
                     self.speed_up = True
+                elif event.key == pygame.K_f:
+                    self.simulation.enable_profiling(self.simulation.profiler is None)
+                elif event.key in (pygame.K_EQUALS, pygame.K_PLUS, pygame.K_KP_PLUS):
+                    self.warp = min(self.warp * 2, MAX_WARP)
+                elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+                    self.warp = max(self.warp / 2, MIN_WARP)
             elif event.type == pygame.KEYUP:
                 if event.key == pygame.K_s:
                     self.speed_up = False
@@ -71,12 +122,83 @@ class Viewer:
 
     def draw(self):
         self.py_display.fill((255, 255, 255))
-        #self.display.draw_log("FPS: " + str(int(self.clock.get_fps())), (255, 0, 0))
+        if self.simulation.profiler is not None:
+            self.display.draw_log("FPS: " + str(int(self.clock.get_fps())), (255, 0, 0))
+        if self.speed_up or self.warp != 1:
+            target = "max" if self.speed_up else f"{self.warp:g}x"
+            self.display.draw_log(f"Speed: {self.sim_rate:.1f}x (target {target})", (255, 0, 0))
         self.simulation.draw()
+        if self.simulation.profiler is not None:
+            self.simulation.profiler.draw(self.display)
         self.display.draw_circle(self.mouse_pos(), self.mouse_size, (0, 0, 0), thickness=1)
         pygame.display.update()
         self.display.clear_log()
 
+class ReplayViewer:
+
+    def __init__(self, recording):
+        pygame.init()
+        self.py_display = pygame.display.set_mode((SCREEN_SIZE, SCREEN_SIZE))
+        self.clock = pygame.time.Clock()
+        self.FPS = FPS
+
+        self.recording = recording
+        self.display = Display(SCREEN_SIZE, (0, 0), self.py_display)
+
+        self.running = True
+        self.playing = True
+        self.frame = 0
+
+    def run(self):
+        while self.running:
+            self.clock.tick(self.FPS)
+            self.handle_events()
+            if self.playing:
+                self.seek(self.frame + 1)
+            self.draw()
+
+    def seek(self, frame):
+        self.frame = min(max(frame, 0), len(self.recording) - 1)
+
+    def handle_events(self):
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.running = False
+            elif event.type == pygame.KEYDOWN:
+                step = 100 if event.mod & pygame.KMOD_SHIFT else 1
+                if event.key == pygame.K_SPACE:
+                    self.playing = not self.playing
+                elif event.key == pygame.K_RIGHT:
+                    self.seek(self.frame + step)
+                elif event.key == pygame.K_LEFT:
+                    self.seek(self.frame - step)
+                elif event.key == pygame.K_HOME:
+                    self.seek(0)
+                elif event.key == pygame.K_END:
+                    self.seek(len(self.recording) - 1)
+
+    def draw(self):
+        self.py_display.fill((255, 255, 255))
+        frame = self.recording[self.frame]
+        # version 1 recordings have no hydra axis
+        positions = frame["positions"].reshape(self.recording.n_hydras, -1, 2)
+        pressure = np.atleast_1d(frame["pressure"])
+
+        self.display.draw_log(f"Time: {frame['time']:.2f}", (255, 0, 0))
+        self.display.draw_log(f"Frame: {self.frame + 1}/{len(self.recording)}", (0, 0, 0))
+        self.display.draw_log("Pressure: " + " ".join(f"{p:.2f}" for p in pressure), (0, 0, 0))
+
+        a = self.recording.muscle_a
+        b = self.recording.muscle_b
+        n = self.recording.n_endoderm
+        for pos in positions:
+            self.display.draw_segments(pos[a[:n]], pos[b[:n]], ENDODERM_COLOR, 1)
+            self.display.draw_segments(pos[a[n:]], pos[b[n:]], ECTODERM_COLOR, 2)
+            self.display.draw_circles(pos, CELL_RADIUS, CELL_COLOR)
+
+        pygame.display.update()
+        self.display.clear_log()
+
 class Display:
         def __init__(self, screen_size, pos, display):
             self.screen_size = screen_size
@@ -85,15 +207,72 @@ class Display:
             self.font_size = 18
             self.font = pygame.font.SysFont("Arial" , self.font_size , bold = True)
             self.log_y = 0
+            self.sprites = {}
+            self.map_surfaces = {}
 
         def draw_circle(self, pos, radius, color, thickness=2):
             try:
-                pygame.draw.circle(self.display, color, self.convert_coordinates(pos), radius, thickness)
-            except:
-                pass
+                center = self.convert_coordinates(pos)
+            except (ValueError, OverflowError):
+                # exploded bodies end up at nan/inf, skip them rather than crash the viewer
+                return
+            pygame.draw.circle(self.display, color, center, radius, thickness)
         
         def draw_line(self, pos1, pos2, color, width):
             pygame.draw.line(self.display, color, self.convert_coordinates(pos1), self.convert_coordinates(pos2), width)
+
+        def draw_lines(self, points, color, width):
+            points = self.convert_points(points)
+            if len(points) > 1 and np.isfinite(points).all():
+                pygame.draw.lines(self.display, color, False, points.tolist(), width)
+
+        def draw_segments(self, starts, ends, color, width):
+            starts = self.convert_points(starts)
+            ends = self.convert_points(ends)
+            finite = np.isfinite(starts).all(axis=1) & np.isfinite(ends).all(axis=1)
+            for p1, p2 in zip(starts[finite].tolist(), ends[finite].tolist()):
+                pygame.draw.line(self.display, color, p1, p2, width)
+
+        def circle_sprite(self, radius, color, thickness):
+            key = (radius, tuple(color), thickness)
+            if key not in self.sprites:
+                size = int(2 * radius + 1)
+                sprite = pygame.Surface((size, size), pygame.SRCALPHA)
+                pygame.draw.circle(sprite, color, (radius, radius), radius, thickness)
+                self.sprites[key] = sprite
+            return self.sprites[key]
+
+        def draw_circles(self, positions, radius, color, thickness=2):
+            sprite = self.circle_sprite(radius, color, thickness)
+            corners = self.convert_points(positions) - radius
+            corners = corners[np.isfinite(corners).all(axis=1)]
+            self.display.blits([(sprite, corner) for corner in corners.tolist()], doreturn=False)
+
+        def draw_activation_map(self, amap):
+            radius = amap.size / 2
+            centers = self.convert_points(amap.cell_positions().reshape(-1, 2))
+            origin = centers.min(axis=0) - radius
+            extent = centers.max(axis=0) + radius + 1 - origin
+            local = (centers - origin).tolist()
+
+            geometry = (amap.map.shape, tuple(amap.pos), amap.size)
+            cached = self.map_surfaces.get(id(amap))
+            if cached is None or cached["geometry"] != geometry:
+                outline = pygame.Surface(extent.astype(int), pygame.SRCALPHA)
+                for center in local:
+                    pygame.draw.circle(outline, (0, 0, 0), center, radius, 1)
+                fill = pygame.Surface(extent.astype(int), pygame.SRCALPHA)
+                cached = {"geometry": geometry, "outline": outline, "fill": fill, "values": None}
+                self.map_surfaces[id(amap)] = cached
+
+            values = amap.map.tobytes()
+            if cached["values"] != values:
+                cached["fill"].fill((0, 0, 0, 0))
+                for center, color in zip(local, amap.colors().reshape(-1, 3).tolist()):
+                    pygame.draw.circle(cached["fill"], color, center, radius, 0)
+                cached["values"] = values
+
+            self.display.blits([(cached["fill"], origin.tolist()), (cached["outline"], origin.tolist())], doreturn=False)
         
         def draw_text(self, text, pos, color):
             text = self.font.render(text, True, color)
@@ -110,13 +289,27 @@ class Display:
         def convert_coordinates(self, pos):
             x, y = pos
             return int(x) + self.screen_size / 2, self.screen_size - int(y)
+
+        def convert_points(self, points):
+            points = np.trunc(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+            return np.stack([points[:, 0] + self.screen_size / 2, self.screen_size - points[:, 1]], axis=1)
     
 if __name__ == "__main__":
-    simulation = simulation.Simulation()
-    simulation.createHydra()
-    simulation.hydra.load_brain("./learning/model.pt")
-    print("Simulation created")
-    viewer = Viewer(simulation)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Hydra simulation viewer")
+    parser.add_argument("--replay", default=None, help="scrub through a recording directory instead of simulating")
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        from recorder import Recording
+        viewer = ReplayViewer(Recording(args.replay))
+    else:
+        simulation = simulation.Simulation(sleep=True)
+        simulation.createHydra()
+        simulation.hydra.load_brain("./learning/model.pack")
+        print("Simulation created")
+        viewer = Viewer(simulation)
     print("Running viewer")
     viewer.run()
     pygame.quit()